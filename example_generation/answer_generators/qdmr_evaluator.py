@@ -5,7 +5,7 @@ import spacy
 
 from example_generation.answer_generators.auxilary_methods import \
     comparison_parse_structure, comparison_get_answer_from_step_index
-from qdmr_transforms.qdmr_identifier import StepIdentifier
+from qdmr_transforms.qdmr_identifier import identify_qdmr_step
 from src.reference_utils import MAX_STEPS
 
 nlp = spacy.load('en')
@@ -242,12 +242,11 @@ def evalute_qdmr(qdmr):
     # for simple arithmetic/aggregation steps - calculate the answer directly, and ignore other steps.
     evaluated_step_answers = [None] * len(qdmr["transformed"])
     num_resolved_steps = len([step for step in evaluated_step_answers if step is not None])
-    step_identifier = StepIdentifier()
     while True:
         for step_i, step_text in enumerate(qdmr["transformed"]):
             if evaluated_step_answers[step_i] is not None:
                 continue
-            step = step_identifier.identify(step_text)
+            step = identify_qdmr_step(step_text)
             step_refs = [
                 int(arg[1:].split(' ')[0])-1 for arg in step.arguments
                 if len(arg) > 1 and arg[0] == '#' and arg[1].isdigit()
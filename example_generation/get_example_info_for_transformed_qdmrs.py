@@ -9,8 +9,7 @@ from example_generation.answer_generators.generate_answer import get_transformed
 from example_generation.answer_generators.generate_answer_constraints import get_transformed_qdmr_answer_constraints
 from example_generation.utils import extract_drop_subset, extract_hotpotqa_subset
 from example_generation.get_examples_from_example_info import answer_to_drop_format, answer_to_hotpot_squad_format
-from src.data.dataset_readers.drop import DropReader
-from src.data.dataset_readers.hotpotqa import HotpotQASQuADReader
+from src.data.dataset_readers.qa_index import load_qa_pairs_dict
 from src.data.dataset_readers.transformed_qdmrs import read_qdmrs
 from qdmr_transforms.qdmr_example import get_transform_base_info
 
@@ -21,7 +20,7 @@ def get_args():
     parse.add_argument("--orig_data_path", type=str, help="data path", required=True)
     parse.add_argument("--gen_qs_path", type=str, help="generated questions path (jsonl)", default="")
     parse.add_argument("--pred_step_ans_path", type=str, default="",
-                       help="path to predicted decomposition step answers (json)")
+                       help="path to predicted decomposition step answers (json or jsonl)")
     parse.add_argument("--dataset_name", choices=['drop', 'hotpot-squad', 'iirc'], help="dataset name", required=True)
     parse.add_argument("--output_path", type=str, default="",
                        help="if not specified, output will be written to the predictions path directory")
@@ -75,6 +74,15 @@ def print_stats(stats, ans_stats, bad_form_ans_stats, no_ans_stats, ans_consts_s
     print('\n')
 
 
+def read_predicted_step_answers(pred_step_ans_path):
+    """Read the output predictions file of run_model.py, in json (a list) or jsonl (one record per line) format"""
+    with open(pred_step_ans_path, "r") as fd:
+        content = fd.read()
+    if content.lstrip().startswith("["):
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
 def print_qdmr_info(qdmr):
     print(json.dumps(qdmr, indent=4), '\n')
 
@@ -165,22 +173,13 @@ def main():
     # load predicted decomposition step answers
     predicted_step_ans = None
     if args.pred_step_ans_path != "":
-        with open(args.pred_step_ans_path, "r") as fd:
-            predicted_step_ans = {
-                record["qid"]: record
-                for record in json.load(fd)
-            }
+        predicted_step_ans = {
+            record["qid"]: record
+            for record in read_predicted_step_answers(args.pred_step_ans_path)
+        }
 
     # add original data info + generate answers to transformed qdmrs
-    dataset_reader = None
-    just_qids = True
-    if args.dataset_name in ["drop", "iirc"]:
-        dataset_reader = DropReader()
-        if args.dataset_name == "drop":
-            just_qids = False
-    elif args.dataset_name == "hotpot-squad":
-        dataset_reader = HotpotQASQuADReader()
-    qa_pairs = dataset_reader.get_qa_pairs_dict(args.orig_data_path, just_qids=just_qids)
+    qa_pairs = load_qa_pairs_dict(args.orig_data_path, args.dataset_name)
 
     add_example_info(qdmrs, qa_pairs, generated_questions, predicted_step_ans, args.dataset_name,
                      args.allow_yes_no, args.debug_prints_ratio)
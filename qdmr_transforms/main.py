@@ -15,6 +15,13 @@ def get_args():
     parse.add_argument("--dataset_name", choices=["drop", "hotpotqa", "iirc"], required=True)
     parse.add_argument("--limit_append_boolean_step_per_qdmr", type=int, default=-1,
                        help="the maximum number of append-boolean-step perturbations per example (-1 means no limit).")
+    parse.add_argument("--workers", type=int, default=1,
+                       help="number of worker processes for applying the transformations (1 means no worker processes).")
+    parse.add_argument("--chunk_size", type=int, default=500,
+                       help="number of input QDMRs handled by a worker process at a time.")
+    parse.add_argument("--resume", action="store_true",
+                       help="checkpoint the run after every chunk, and continue a previous run "
+                            "with the same output file from its last checkpoint.")
 
     return parse.parse_args()
 
@@ -26,7 +33,9 @@ def main():
     apply_qdmr_transformations(args.input_file, args.output_file, args.dataset_name,
                                filters=filters, transformations=None, limit=None,
                                limit_append_boolean_step_per_qdmr=args.limit_append_boolean_step_per_qdmr,
-                               numeric_qa_file=args.numeric_qa_file)
+                               numeric_qa_file=args.numeric_qa_file,
+                               workers=args.workers, chunk_size=args.chunk_size,
+                               resume=args.resume)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+from qdmr_transforms.operator_identifier import extract_references
+import re
+
+# triggers of the IdentifyOperator* classes, see operator_identifier.py
+AGGREGATORS = ['number of', 'highest', 'largest', 'lowest', 'smallest', 'maximum', 'minimum',
+               'max', 'min', 'sum', 'total', 'average', 'avg', 'mean of', 'first', 'last',
+               'longest', 'shortest']
+SUPERLATIVES = ['highest', 'largest', 'most', 'smallest', 'lowest', 'smallest', 'least',
+                'longest', 'shortest', 'biggest', 'maximum', 'minimum', 'top', 'in top']
+SUPERLATIVE_PHRASES = ["%s %s" % (aux, sup)
+                       for aux in ["is", "are"]
+                       for sup in SUPERLATIVES + ["the %s" % sup for sup in SUPERLATIVES]]
+COMPARATIVES = ['same as', 'higher than', 'larger than', 'smaller than', 'lower than',
+                'more', 'less', 'at least', 'at most', 'equal', 'is ', 'are', 'was', 'contain',
+                'include', 'has', 'have', 'end with', 'start with', 'ends with',
+                'starts with', 'begin']
+DISCARDS = ['besides', 'not in']
+SORTS = [' sorted by', ' order by', ' ordered by']
+ARITHMETICS = ['sum', 'difference', 'multiplication', 'division']
+TRIGGERS = ['for each', 'where', 'both', ' and', 'at most', 'at least'] + \
+           SUPERLATIVE_PHRASES + COMPARATIVES + DISCARDS + SORTS
+
+
+def compile_triggers(triggers):
+    """Returns a pattern matching the longest trigger that starts at every position of a string,
+    and a mapping from each trigger to all the triggers that are its prefixes.
+    Together, a single scan of a string finds all the triggers it contains."""
+    triggers = list(dict.fromkeys(triggers))
+    longest_first = sorted(triggers, key=len, reverse=True)
+    pattern = re.compile("(?=(%s))" % "|".join(re.escape(trigger) for trigger in longest_first))
+    prefixes = {trigger: frozenset(t for t in triggers if trigger.startswith(t))
+                for trigger in triggers}
+    return pattern, prefixes
+
+
+class OperatorClassifier(object):
+    """
+    Single-pass classifier of QDMR step operators.
+    Extracts the step references once and finds all operator triggers in one scan of the step,
+    instead of running every IdentifyOperator* class on the step.
+    Returns the same potential operators as the IdentifyOperator* classes.
+    """
+
+    def __init__(self):
+        self.trigger_pattern, self.trigger_prefixes = compile_triggers(TRIGGERS)
+        self.superlative_phrases = frozenset(SUPERLATIVE_PHRASES)
+        self.superlative_tokens = list(dict.fromkeys(frozenset(s.split()) for s in SUPERLATIVE_PHRASES))
+        self.comparatives = frozenset(COMPARATIVES)
+        self.discards = frozenset(DISCARDS)
+        self.sorts = frozenset(SORTS)
+        aggregators = "|".join(re.escape(agg) for agg in AGGREGATORS)
+        self.aggregate_prefix = re.compile("(?:the )?(?:%s)(?: of)? #" % aggregators)
+        self.arithmetic_prefix = re.compile("(?:the )?(?:%s)" % "|".join(ARITHMETICS))
+        self.boolean_prefix = re.compile("(?:if|is|are|did) ")
+        self.project_ref = re.compile(r"[\s]+[#]+[0-9\s]+")
+        self.union_refs = re.compile(r"^[#0-9,\s]+$")
+        self.discard_start_ref = re.compile(r"^[#]+[0-9]+[\s]+")
+        self.discard_end_ref = re.compile(r"[#]+[0-9]+$")
+
+    def triggers(self, step):
+        """Returns the set of all triggers contained in the step"""
+        found = set()
+        for match in self.trigger_pattern.finditer(step):
+            found.update(self.trigger_prefixes[match.group(1)])
+        return found
+
+    def potential_operators(self, step, references):
+        refs = len(references)
+        triggers = self.triggers(step)
+        starts_with_ref = step.startswith("#") or step.startswith("the #")
+        operators = set()
+        if refs == 0:
+            operators.add("select")
+        if 0 < refs <= 3 and starts_with_ref:
+            operators.add("filter")
+        if refs == 1 and self.project_ref.search(step):
+            operators.add("project")
+        if refs == 1 and self.aggregate_prefix.match(step):
+            operators.add("aggregate")
+        if "for each" in triggers and refs > 0:
+            operators.add("group")
+        if refs == 2 and "where" in triggers and starts_with_ref and self.is_superlative(step, triggers):
+            operators.add("superlative")
+        if 2 <= refs <= 3 and "where" in triggers and starts_with_ref and not triggers.isdisjoint(self.comparatives):
+            operators.add("comparative")
+        if refs > 1 and self.union_refs.search(step.replace('and', ',').replace('or', ',')):
+            operators.add("union")
+        if refs >= 2 and "both" in triggers and " and" in triggers:
+            operators.add("intersection")
+        if 1 <= refs <= 2 and (self.discard_start_ref.search(step) or self.discard_end_ref.search(step)) \
+                and not triggers.isdisjoint(self.discards):
+            operators.add("discard")
+        if not triggers.isdisjoint(self.sorts):
+            operators.add("sort")
+        if refs > 0 and self.boolean_prefix.match(step.lower()):
+            operators.add("boolean")
+        if refs > 1 and self.arithmetic_prefix.match(step):
+            operators.add("arithmetic")
+        if refs > 1 and step.lower().startswith('which'):
+            operators.add("comparison")
+        return operators
+
+    def is_superlative(self, step, triggers):
+        if not triggers.isdisjoint(self.superlative_phrases):
+            return True
+        if "at most" in triggers or "at least" in triggers:
+            return False
+        step_tokens = set(step.split())
+        for sup_tokens in self.superlative_tokens:
+            if sup_tokens.issubset(step_tokens):
+                return True
+        return False
+
+    def classify(self, step):
+        """Returns the step references and its set of potential operators"""
+        references = extract_references(step)
+        return references, self.potential_operators(step, references)
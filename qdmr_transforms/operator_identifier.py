@@ -2,6 +2,23 @@ from qdmr_transforms.utils import *
 import re
 
 
+def extract_references(step):
+    """Extracts a list of references to previous steps"""
+    # make sure decomposition does not contain a mere '# ' other than a reference.
+    step = step.replace("# ", "hashtag ")
+    references = []
+    l = step.split(REF)
+    for chunk in l[1:]:
+        if len(chunk) > 1:
+            ref = chunk.split()[0]
+            ref = int(ref)
+            references += [ref]
+        if len(chunk) == 1:
+            ref = int(chunk)
+            references += [ref]
+    return references
+
+
 class IdentifyOperator(object):
     def __init__(self):
         self.step = None
@@ -10,19 +27,7 @@ class IdentifyOperator(object):
 
     def extract_references(self, step):
         """Extracts a list of references to previous steps"""
-        # make sure decomposition does not contain a mere '# ' other than a reference.
-        step = step.replace("# ", "hashtag ")
-        references = []
-        l = step.split(REF)
-        for chunk in l[1:]:
-            if len(chunk) > 1:
-                ref = chunk.split()[0]
-                ref = int(ref)
-                references += [ref]
-            if len(chunk) == 1:
-                ref = int(chunk)
-                references += [ref]
-        return references
+        return extract_references(step)
 
     def extract_aggregate(self):
         """Extract aggregate expression from QDMR step
@@ -59,7 +64,12 @@ class IdentifyOperator(object):
         self.operator = self._identify_op()
         return self.operator
 
-    def extract_args(self, step):
+    def extract_args(self, step, references=None):
+        """Extracts the arguments of the last identified step,
+        or of the given step if its references are also given."""
+        if references is not None:
+            self.step = step
+            self.references = references
         args = self._extract_args()
         return [a.strip() for a in args]
 
@@ -1,13 +1,20 @@
+import json
+import os
 import pandas as pd
 from typing import Dict
 from tqdm import tqdm
 
 from qdmr_transforms.qdmr_example import QDMRExample
 from qdmr_transforms.qdmr_transformations import extract_comparator
+from src.hash_utils import file_content_hash
 
 OP_REPLACE_STEPS = ["aggregate", "arithmetic", "comparison", "comparative", "superlative", "boolean"]
 REF = "#"
 CONST = "const"
+DISTRIBUTION_INDEX_SUFFIX = ".distribution.json"
+# the version of the distribution computation (qdmr_dataset_distribution), which keys the index files together
+# with the dataset file hash. bump it whenever the computation changes, so stale index files are recomputed.
+DISTRIBUTION_INDEX_VERSION = 1
 
 
 def read_qdmr_data(csv_file):
@@ -54,6 +61,31 @@ def qdmr_dataset_distribution(dataset_file):
     return results
 
 
+def load_qdmr_dataset_distribution(dataset_file, index_file=None):
+    """same as qdmr_dataset_distribution, but the distribution is persisted to an index file
+    (by default, next to the dataset file) keyed by the hash of the dataset file content and the
+    DISTRIBUTION_INDEX_VERSION, and loaded from it as long as neither of them changes."""
+    index_file = index_file if index_file is not None else dataset_file + DISTRIBUTION_INDEX_SUFFIX
+    content_hash = file_content_hash(dataset_file)
+    if os.path.exists(index_file):
+        with open(index_file, "r") as fd:
+            index = json.load(fd)
+        if index.get("content_hash") == content_hash and index.get("version") == DISTRIBUTION_INDEX_VERSION:
+            print(f"* Loaded QDMR data distribution from: {index_file}")
+            return index["distribution"]
+    results = qdmr_dataset_distribution(dataset_file)
+    try:
+        tmp_index_file = index_file + ".tmp"
+        with open(tmp_index_file, "w") as fd:
+            json.dump({"version": DISTRIBUTION_INDEX_VERSION, "content_hash": content_hash,
+                       "distribution": results}, fd)
+        os.replace(tmp_index_file, index_file)
+        print(f"* Wrote QDMR data distribution to: {index_file}")
+    except OSError as e:
+        print(f"* Could not write QDMR data distribution to {index_file}: {e}")
+    return results
+
+
 def update_operator_counts(counts_dict, program):
     new_dict = counts_dict
     unique_ops = list(dict.fromkeys(program))
@@ -1,9 +1,12 @@
 from qdmr_transforms.qdmr_identifier import *
 from src.models.iterative.reference_utils import get_references
+import pandas as pd
 
 BREAK_SEP = '_'
 TRANSFORM_SEP = '+'
 TRANSFORM_INFO_SEP = '-'
+# the parts of a transformed example id, see parse_transformed_id
+TRANSFORM_ID_FIELDS = ['orig_id', 'transform_base', 'transform_step', 'transform_info_parts']
 
 
 class QDMRExample:
@@ -18,9 +21,9 @@ class QDMRExample:
         self.example_id = example_id
         self.question = question
         self.qdmr = qdmr
-        self.original_steps_text = parse_decomposition(qdmr)
         builder = QDMRProgramBuilder(qdmr)
         builder.build()
+        self.original_steps_text = builder.steps_text
         self.steps = builder.steps
         self.transform = transform
         self.transformed_question = None
@@ -30,8 +33,11 @@ class QDMRExample:
         self.transformed_question = transformed_question
 
     def qdmr_encoding(self):
+        return self.steps_encoding(self.steps)
+
+    def steps_encoding(self, steps):
         prefix = "return "
-        return prefix + " ;return ".join(self.qdmr_steps_text())
+        return prefix + " ;return ".join([self.step_to_text(step) for step in steps])
 
     def qdmr_steps_text(self):
         step_phrases = [self.step_to_text(step) for step in self.steps]
@@ -167,6 +173,54 @@ class QDMRExample:
         return True
 
 
+class TransformedQDMRExample(QDMRExample):
+    """
+    A transformed QDMR example, given either as the transformed QDMR string or as an overlay of
+    the original example steps: the (unmodified) original steps, a few overriding steps by index,
+    and the number of steps of the transformed QDMR.
+    The QDMR string and its parsed steps are computed lazily, only when they are needed.
+    """
+
+    def __init__(self, example_id, question, transform, qdmr=None,
+                 base_steps=None, step_overrides=None, num_steps=None):
+        assert qdmr is not None or base_steps is not None
+        self.example_id = example_id
+        self.question = question
+        self.transform = transform
+        self.transformed_question = None
+        self.base_steps = base_steps
+        self.step_overrides = step_overrides if step_overrides is not None else {}
+        if num_steps is None and base_steps is not None:
+            num_steps = len(base_steps)
+        self.num_steps = num_steps
+        self._qdmr = qdmr
+        self._builder = None
+
+    def overlay_steps(self):
+        return [self.step_overrides[i] if i in self.step_overrides else self.base_steps[i]
+                for i in range(self.num_steps)]
+
+    @property
+    def qdmr(self):
+        if self._qdmr is None:
+            self._qdmr = self.steps_encoding(self.overlay_steps())
+        return self._qdmr
+
+    @property
+    def steps(self):
+        return self._build().steps
+
+    @property
+    def original_steps_text(self):
+        return self._build().steps_text
+
+    def _build(self):
+        if self._builder is None:
+            self._builder = QDMRProgramBuilder(self.qdmr)
+            self._builder.build()
+        return self._builder
+
+
 def get_orig_example_id(transformed_id, clean=False):
     orig_example_id = transformed_id.split(TRANSFORM_SEP, 1)[0]
     if clean is False:
@@ -194,3 +248,43 @@ def get_transform_base_info(transform):
 def get_transform_base_info_parts(transform_info):
     transform_parts = transform_info.split(TRANSFORM_INFO_SEP)
     return transform_parts
+
+
+def get_transform_step(transform_info_parts):
+    """Return the index of the transformed step, if the transformation info starts with one"""
+    return int(transform_info_parts[0]) if transform_info_parts[0].isdigit() else None
+
+
+def parse_transformed_id(transformed_id):
+    """Split a transformed example id, of the form <orig id>+<transform base>+<transform info>,
+    into the fields in TRANSFORM_ID_FIELDS."""
+    transform_base, transform_info = get_transform_base_info(get_transform_from_example_id(transformed_id))
+    transform_info_parts = get_transform_base_info_parts(transform_info)
+    return {
+        'orig_id': get_orig_example_id(transformed_id),
+        'transform_base': transform_base,
+        'transform_step': get_transform_step(transform_info_parts),
+        'transform_info_parts': transform_info_parts
+    }
+
+
+def parse_transformed_ids(transformed_ids, clean=False):
+    """Vectorized parse_transformed_id over a series of transformed example ids.
+    Returns a dataframe with the TRANSFORM_ID_FIELDS columns (and a transform_info column),
+    with the same index as the given series."""
+    transformed_ids = pd.Series(transformed_ids, dtype=object)
+    parts = transformed_ids.str.split(TRANSFORM_SEP, n=2, expand=True).reindex(columns=range(3))
+    orig_ids = parts[0]
+    if clean:
+        orig_ids = orig_ids.str.replace("_q_", "_q-", regex=False).str.split(BREAK_SEP).str[-1]\
+            .str.replace("q-", "q_", regex=False)
+    transform_info_parts = parts[2].str.split(TRANSFORM_INFO_SEP)
+    transform_step = transform_info_parts.str[0]
+    return pd.DataFrame({
+        'orig_id': orig_ids,
+        'transform_base': parts[1],
+        'transform_step': pd.to_numeric(transform_step.where(transform_step.str.isdigit() == True),
+                                        errors='coerce').astype('Int64'),
+        'transform_info_parts': transform_info_parts,
+        'transform_info': parts[2]
+    }, index=transformed_ids.index)
@@ -1,5 +1,7 @@
 from qdmr_transforms.operator_identifier import *
+from qdmr_transforms.operator_classifier import OperatorClassifier
 from qdmr_transforms.utils import *
+from functools import lru_cache
 
 
 class QDMRStep:
@@ -11,9 +13,55 @@ class QDMRStep:
     def __str__(self):
         return "%s%a" % (self.operator.upper(), self.arguments)
 
+    def replace_argument(self, index, argument):
+        """Returns a new step with the argument at the given index replaced"""
+        arguments = list(self.arguments)
+        arguments[index] = argument
+        return QDMRStep(self.step, self.operator, arguments)
+
+
+def resolve_operator(potential_operators):
+    """Returns the operator of a step given all of its potential operators"""
+    # no matching operator found
+    if len(potential_operators) == 0:
+        return None
+    operators = potential_operators.copy()
+    # duplicate candidates
+    while len(operators) > 1:
+        # avoid project duplicity with aggregate
+        if "project" in operators:
+            operators.remove("project")
+        # avoid filter duplcitiy with comparative, superlative, sort, discard
+        elif "filter" in operators:
+            operators.remove("filter")
+        # return boolean (instead of intersect)
+        elif "boolean" in operators:
+            operators = {"boolean"}
+        # return intersect (instead of filter)
+        elif "intersect" in operators:
+            operators = {"intersect"}
+        # return superlative (instead of comparative)
+        elif "superlative" in operators:
+            operators = {"superlative"}
+        # return group (instead of arithmetic)
+        elif "group" in operators:
+            operators = {"group"}
+        # return comparative (instead of discard)
+        elif "comparative" in operators:
+            operators = {"comparative"}
+        # return intersection (instead of comparison)
+        elif "intersection" in operators:
+            operators = {"intersection"}
+        else:
+            # no valid operator
+            assert (len(operators) == 1)
+    return list(operators)[0]
+
 
 class StepIdentifier(object):
-    def __init__(self):
+    def __init__(self, compiled=True):
+        """If compiled, step operators are identified in a single pass with the OperatorClassifier,
+        otherwise by running each of the operator identifiers on the step."""
         self.identifiers = {"select": IdentifyOperatorSelect(),
                             "filter": IdentifyOperatorFilter(),
                             "project": IdentifyOperatorProject(),
@@ -28,101 +76,110 @@ class StepIdentifier(object):
                             "boolean": IdentifyOperatorBoolean(),
                             "arithmetic": IdentifyOperatorArithmetic(),
                             "comparison": IdentifyOperatorComparison()}
+        self.classifier = OperatorClassifier() if compiled else None
         self.operator = None
+        self.references = None
 
     def step_type(self, step_text):
-        potential_operators = set()
-        for op in self.identifiers:
-            identifier = self.identifiers[op]
-            if identifier.identify_op(step_text):
-                potential_operators.add(op)
-        # no matching operator found
-        if len(potential_operators) == 0:
-            return None
-        operators = potential_operators.copy()
-        # duplicate candidates
-        while len(operators) > 1:
-            # avoid project duplicity with aggregate
-            if "project" in operators:
-                operators.remove("project")
-            # avoid filter duplcitiy with comparative, superlative, sort, discard
-            elif "filter" in operators:
-                operators.remove("filter")
-            # return boolean (instead of intersect)
-            elif "boolean" in operators:
-                operators = {"boolean"}
-            # return intersect (instead of filter)
-            elif "intersect" in operators:
-                operators = {"intersect"}
-            # return superlative (instead of comparative)
-            elif "superlative" in operators:
-                operators = {"superlative"}
-            # return group (instead of arithmetic)
-            elif "group" in operators:
-                operators = {"group"}
-            # return comparative (instead of discard)
-            elif "comparative" in operators:
-                operators = {"comparative"}
-            # return intersection (instead of comparison)
-            elif "intersection" in operators:
-                operators = {"intersection"}
-            else:
-                # no valid operator
-                assert (len(operators) == 1)
-        operator = list(operators)[0]
+        if self.classifier is not None:
+            self.references, potential_operators = self.classifier.classify(step_text)
+        else:
+            potential_operators = set()
+            for op in self.identifiers:
+                identifier = self.identifiers[op]
+                if identifier.identify_op(step_text):
+                    potential_operators.add(op)
+            self.references = None
+        operator = resolve_operator(potential_operators)
         self.operator = operator
         return operator
 
     def step_args(self, step_text):
         self.operator = self.step_type(step_text)
+        return self._step_args(step_text)
+
+    def _step_args(self, step_text):
+        # arguments of the last identified step
         identifier = self.identifiers[self.operator]
-        args = identifier.extract_args(step_text)
+        args = identifier.extract_args(step_text, references=self.references)
         return args
 
     def identify(self, step_text):
         self.operator = self.step_type(step_text)
-        args = self.step_args(step_text)
+        args = self._step_args(step_text)
         return QDMRStep(step_text, self.operator, args)
 
 
+QDMR_CACHE_SIZE = 2 ** 16
+STEP_CACHE_SIZE = 2 ** 18
+
+_step_identifier = StepIdentifier()
+
+
+@lru_cache(maxsize=STEP_CACHE_SIZE)
+def identify_step(step_text):
+    """Returns the (operator, arguments) of a step, with the arguments as a tuple.
+    Results are cached, so the returned values must not be modified."""
+    step = _step_identifier.identify(step_text)
+    return step.operator, tuple(step.arguments)
+
+
+@lru_cache(maxsize=QDMR_CACHE_SIZE)
+def parse_qdmr(qdmr_text):
+    """Returns the parsed steps of a QDMR, as a tuple of (step_text, operator, arguments) tuples.
+    The operator and arguments of steps that could not be identified are None.
+    Results are cached, so the returned values must not be modified."""
+    steps = []
+    for step_text in parse_decomposition(qdmr_text):
+        try:
+            operator, arguments = identify_step(step_text)
+        except:
+            print("Unable to identify step: %s" % step_text)
+            operator, arguments = None, None
+        steps += [(step_text, operator, arguments)]
+    return tuple(steps)
+
+
+def identify_qdmr_step(step_text):
+    """Returns a new QDMRStep of a step, identified with the step cache"""
+    operator, arguments = identify_step(step_text)
+    return QDMRStep(step_text, operator, list(arguments))
+
+
+def parse_cache_info():
+    """Returns the hits, misses and sizes of the QDMR and step caches"""
+    return {"qdmr": parse_qdmr.cache_info()._asdict(),
+            "step": identify_step.cache_info()._asdict()}
+
+
+def clear_parse_cache():
+    parse_qdmr.cache_clear()
+    identify_step.cache_clear()
+
+
 class QDMRProgramBuilder(object):
     def __init__(self, qdmr_text):
         self.qdmr_text = qdmr_text
+        self.steps_text = None
         self.steps = None
         self.operators = None
         self.program = None
 
     def build(self):
-        self.get_operators()
-        self.build_steps()
+        # steps are parsed and identified once (and cached) for both the operators and the steps.
+        parsed_steps = parse_qdmr(self.qdmr_text)
+        self.steps_text = [step_text for step_text, _, _ in parsed_steps]
+        self.operators = [operator for _, operator, _ in parsed_steps]
+        self.steps = [QDMRStep(step_text, operator, list(arguments)) if operator is not None else None
+                      for step_text, operator, arguments in parsed_steps]
         return True
 
     def build_steps(self):
-        self.steps = []
-        steps = parse_decomposition(self.qdmr_text)
-        step_identifier = StepIdentifier()
-        for step_text in steps:
-            try:
-                step = step_identifier.identify(step_text)
-            except:
-                print("Unable to identify step: %s" % step_text)
-                step = None
-            finally:
-                self.steps += [step]
+        self.build()
         return self.steps
 
     def get_operators(self):
-        self.operators = []
-        steps = parse_decomposition(self.qdmr_text)
-        step_identifier = StepIdentifier()
-        for step_text in steps:
-            try:
-                op = step_identifier.step_type(step_text)
-            except:
-                print("Unable to identify operator: %s" % step_text)
-                op = None
-            finally:
-                self.operators += [op]
+        self.build()
         return self.operators
 
     def build_program(self):
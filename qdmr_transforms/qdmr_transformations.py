@@ -1,12 +1,13 @@
 from qdmr_transforms.qdmr_editor import QDMREditor
-from qdmr_transforms.qdmr_example import QDMRExample, TRANSFORM_SEP, TRANSFORM_INFO_SEP
+from qdmr_transforms.qdmr_example import TransformedQDMRExample, TRANSFORM_SEP, TRANSFORM_INFO_SEP
 from qdmr_transforms.qdmr_identifier import QDMRStep
 from qdmr_transforms.question_transformation import transform_comparison_question, \
     transform_append_boolean_question, transform_replace_boolean_question
 import re
 
 import random
-random.seed(42)
+
+RANDOM_SEED = 42
 
 numbers = {"zero": "0", "one": "1", "two": "2", "three": "3", "four": "4", "five": "5",
            "six": "6", "seven": "7", "eight": "8", "nine": "9", "ten": "10"}
@@ -96,15 +97,22 @@ def is_float(phrase):
 # Input is a single QDMRExample
 # Output is a list of transformed QDMRExample objects
 
-import copy
-
 
-def transformed_qdmr(original_example, new_qdmr, transform):
+def transformed_qdmr(original_example, transform, new_qdmr=None, step_overrides=None, num_steps=None):
+    """Returns a transformed example, given either by its new QDMR string or by the steps
+    that override the original example steps (without copying the original example)."""
     new_example_id = original_example.example_id + TRANSFORM_SEP + transform
-    return QDMRExample(example_id=new_example_id,
-                       question=original_example.question,
-                       qdmr=new_qdmr,
-                       transform=transform)
+    if new_qdmr is not None:
+        return TransformedQDMRExample(example_id=new_example_id,
+                                      question=original_example.question,
+                                      transform=transform,
+                                      qdmr=new_qdmr)
+    return TransformedQDMRExample(example_id=new_example_id,
+                                  question=original_example.question,
+                                  transform=transform,
+                                  base_steps=original_example.steps,
+                                  step_overrides=step_overrides,
+                                  num_steps=num_steps)
 
 
 class QDMRTransform(object):
@@ -155,7 +163,6 @@ class OpReplaceTransform(QDMRTransform):
         """
         transforms = []
         qdmr_program = qdmr_example.steps
-        qdmr_copies = []
         for i in range(len(qdmr_program)):
             step = qdmr_program[i]
             if step.operator == "aggregate" and is_last_step(i, qdmr_program):
@@ -163,11 +170,9 @@ class OpReplaceTransform(QDMRTransform):
                 if original_op in ["min", "max", "sum", "avg"]:
                     for op in ["min", "max", "count"]:
                         if op != original_op:
-                            qdmr_copy = copy.deepcopy(qdmr_example)
-                            qdmr_copy.steps[i].arguments[0] = op
                             transforms += [
                                 transformed_qdmr(qdmr_example,
-                                                 new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                 step_overrides={i: step.replace_argument(0, op)},
                                                  transform=f"op_replace_aggregate{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                             ]
         return transforms
@@ -186,11 +191,10 @@ class OpReplaceTransform(QDMRTransform):
                 original_op = step.arguments[0]
                 for op in ["sum", "difference", "multiplication", "division"]:
                     if op != original_op:
-                        qdmr_copy = copy.deepcopy(qdmr_example)
-                        qdmr_copy.steps[i].arguments[0] = op
+                        step_overrides = {i: step.replace_argument(0, op)}
                         transforms += [
                             transformed_qdmr(qdmr_example,
-                                             new_qdmr=qdmr_copy.qdmr_encoding(),
+                                             step_overrides=step_overrides,
                                              transform=f"op_replace_arithmetic{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                         ]
                         if (op == "difference" and
@@ -202,13 +206,13 @@ class OpReplaceTransform(QDMRTransform):
                             # Meant to handle question generator producing illogical difference questions
                             #   where the answer is a negative number
                             #   (e.g., "how many more eyes does a person have than fingers?")
-                            qdmr_copy_variant = copy.deepcopy(qdmr_copy)
-                            first_step, second_step = qdmr_copy_variant.steps[:2]
-                            qdmr_copy_variant.steps[0] = second_step
-                            qdmr_copy_variant.steps[1] = first_step
+                            first_step, second_step = qdmr_program[:2]
+                            variant_step_overrides = dict(step_overrides)
+                            variant_step_overrides[0] = second_step
+                            variant_step_overrides[1] = first_step
                             transforms += [
                                 transformed_qdmr(qdmr_example,
-                                                 new_qdmr=qdmr_copy_variant.qdmr_encoding(),
+                                                 step_overrides=variant_step_overrides,
                                                  transform=f"op_replace_arithmetic{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}_VARIANT")
                             ]
         return transforms
@@ -230,10 +234,8 @@ class OpReplaceTransform(QDMRTransform):
                 ops = ["min", "max"] if original_op in ["min", "max"] else ["true", "false"]
                 for op in ops:
                     if op != original_op:
-                        qdmr_copy = copy.deepcopy(qdmr_example)
-                        qdmr_copy.steps[i].arguments[0] = op
                         transformed_example = transformed_qdmr(qdmr_example,
-                                                               new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                               step_overrides={i: step.replace_argument(0, op)},
                                                                transform=f"op_replace_comparison{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                         transformed_example.set_transformed_question(
                             transform_comparison_question(transformed_example.question))
@@ -268,11 +270,9 @@ class OpReplaceTransform(QDMRTransform):
                             if op != comp:
                                 op_phrase = comparatives[op][0]
                                 condition = f"{op_phrase} {value_phrase}"
-                                qdmr_copy = copy.deepcopy(qdmr_example)
-                                qdmr_copy.steps[i].arguments[2] = condition
                                 transforms += [
                                     transformed_qdmr(qdmr_example,
-                                                     new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                     step_overrides={i: step.replace_argument(2, condition)},
                                                      transform=f"op_replace_comparative{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{comp}{TRANSFORM_INFO_SEP}{op}")
                                 ]
         return transforms
@@ -291,11 +291,9 @@ class OpReplaceTransform(QDMRTransform):
                 original_op = step.arguments[0]
                 for op in ["min", "max"]:
                     if op != original_op:
-                        qdmr_copy = copy.deepcopy(qdmr_example)
-                        qdmr_copy.steps[i].arguments[0] = op
                         transforms += [
                             transformed_qdmr(qdmr_example,
-                                             new_qdmr=qdmr_copy.qdmr_encoding(),
+                                             step_overrides={i: step.replace_argument(0, op)},
                                              transform=f"op_replace_superlative{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                         ]
         return transforms
@@ -318,19 +316,15 @@ class OpReplaceTransform(QDMRTransform):
                 if original_op in ["logical_and", "logical_or"]:
                     for op in ["logical_and", "logical_or"]:
                         if op != original_op:
-                            qdmr_copy = copy.deepcopy(qdmr_example)
-                            qdmr_copy.steps[i].arguments[0] = op
                             transforms += [
                                 transformed_qdmr(qdmr_example,
-                                                 new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                 step_overrides={i: step.replace_argument(0, op)},
                                                  transform=f"op_replace_boolean{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                             ]
                     for op in ["true", "false"]:
                         if op != bool_expr:
-                            qdmr_copy = copy.deepcopy(qdmr_example)
-                            qdmr_copy.steps[i].arguments[1] = op
                             transformed_example = transformed_qdmr(qdmr_example,
-                                                                   new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                                   step_overrides={i: step.replace_argument(1, op)},
                                                                    transform=f"op_replace_boolean{TRANSFORM_SEP}{i}{TRANSFORM_INFO_SEP}{original_op}{TRANSFORM_INFO_SEP}{op}")
                             if op == "false":
                                 # check if the question can be automatically transformed to a double negation question
@@ -362,10 +356,8 @@ class PruneLastTransform(QDMRTransform):
         last_step = qdmr_example.steps[-1]
         remove_last_ops = ["filter", "project", "aggregate", "superlative", "comparative", "sort"]
         if last_step.operator in remove_last_ops:
-            qdmr_copy = copy.deepcopy(qdmr_example)
-            qdmr_copy.steps = qdmr_copy.steps[:-1]
             transforms = [transformed_qdmr(qdmr_example,
-                                           new_qdmr=qdmr_copy.qdmr_encoding(),
+                                           num_steps=len(qdmr_example.steps) - 1,
                                            transform=f"prune_last_step{TRANSFORM_SEP}{last_step.operator}")]
         else:
             # remove step and resulting unused steps
@@ -451,12 +443,10 @@ class ChangeLastStepTransform(QDMRTransform):
         for replacement in replacement_steps:
             op_subtype, replacement = replacement[0], replacement[1]
             op_subtype = op_subtype.replace(" ", "_")
-            qdmr_copy = copy.deepcopy(qdmr_example)
-            qdmr_copy.steps[-1] = replacement
-            n = len(qdmr_copy.steps)
+            n = len(qdmr_example.steps)
             transforms += [
                 transformed_qdmr(qdmr_example,
-                                 new_qdmr=qdmr_copy.qdmr_encoding(),
+                                 step_overrides={n - 1: replacement},
                                  transform=f"change_last_step{TRANSFORM_SEP}{n}{TRANSFORM_INFO_SEP}{last_step.operator}{TRANSFORM_INFO_SEP}{replacement.operator}{TRANSFORM_INFO_SEP}{op_subtype}")
             ]
         return transforms
@@ -568,7 +558,10 @@ class AppendBooleanTransform(QDMRTransform):
 
         if self.limit > -1:
             # randomly sample the maximum allowed number of transformations.
-            random.shuffle(transforms)
+            # the sampling is seeded per example, so it does not depend on the order (or process)
+            # in which the examples are transformed.
+            example_random = random.Random(f"{RANDOM_SEED}_{self.qdmr_example.example_id}")
+            example_random.shuffle(transforms)
             transforms = transforms[:self.limit]
 
         return transforms
@@ -588,12 +581,11 @@ class AppendBooleanTransform(QDMRTransform):
         for cond_phrase in ["lower than", "higher than", "equal to"]:
             cond = "is %s %s" % (cond_phrase, value)
             append = create_qdmr_step(qdmr_example, "boolean", [last_step_ref, cond])
-            qdmr_copy = copy.deepcopy(qdmr_example)
-            qdmr_copy.steps += [append]
-            n = len(qdmr_copy.steps)
+            n = len(qdmr_example.steps) + 1
             cond_op = cond_phrase.split()[0]
             transformed_example = transformed_qdmr(qdmr_example,
-                                                   new_qdmr=qdmr_copy.qdmr_encoding(),
+                                                   step_overrides={n - 1: append},
+                                                   num_steps=n,
                                                    transform=f"append_boolean_step{TRANSFORM_SEP}{n}{TRANSFORM_INFO_SEP}{last_step.operator}{TRANSFORM_INFO_SEP}{cond_op}{TRANSFORM_INFO_SEP}{value}")
             question_cond = cond
             if cond_phrase == "equal to":
@@ -1,7 +1,52 @@
 import re
 import spacy
+from collections import OrderedDict
 
-nlp = spacy.load("en")
+# the question heuristics only use the tokens and their lemmas
+SPACY_DISABLED_PIPES = ["parser", "ner"]
+QUESTION_CACHE_SIZE = 2**14
+QUESTION_BATCH_SIZE = 256
+HOW_MANY_TRIGGER = "how many"
+
+_nlp = None
+_parsed_questions = OrderedDict()
+
+
+def get_nlp():
+    """Load the spaCy pipeline on first use, rather than when the module is imported"""
+    global _nlp
+    if _nlp is None:
+        _nlp = spacy.load("en", disable=SPACY_DISABLED_PIPES)
+    return _nlp
+
+
+def _cache_parsed_question(question, parsed):
+    _parsed_questions[question] = parsed
+    if len(_parsed_questions) > QUESTION_CACHE_SIZE:
+        _parsed_questions.popitem(last=False)
+
+
+def parse_question(question):
+    """Return the (cached) spaCy Doc of the question"""
+    if question in _parsed_questions:
+        _parsed_questions.move_to_end(question)
+        return _parsed_questions[question]
+    parsed = get_nlp()(question)
+    _cache_parsed_question(question, parsed)
+    return parsed
+
+
+def parse_questions(questions, batch_size=QUESTION_BATCH_SIZE):
+    """Parse all the distinct questions that are not yet cached in batches, using nlp.pipe"""
+    questions = [q for q in dict.fromkeys(questions) if q not in _parsed_questions]
+    if len(questions) == 0:
+        return
+    for question, parsed in zip(questions, get_nlp().pipe(questions, batch_size=batch_size)):
+        _cache_parsed_question(question, parsed)
+
+
+def clear_question_cache():
+    _parsed_questions.clear()
 
 FLIP_COMPARISON_OP = {'young': 'old',
                       'first': 'second',
@@ -52,10 +97,10 @@ def transform_append_boolean_question(question, new_condition):
 
     # so we don't get an uppercase word in the middle of the new question
     # question = lowercase_first_token(question)
-    trigger = "how many"
+    trigger = HOW_MANY_TRIGGER
     if trigger not in question.lower():
         return None
-    parsed = nlp(question)
+    parsed = parse_question(question)
     how_many_start_index = [
         t.i for i, t in enumerate(parsed)
         if (i < len(parsed) - 1 and
@@ -1,4 +1,4 @@
-from qdmr_transforms.qdmr_distribution import qdmr_program_encoding, qdmr_dataset_distribution
+from qdmr_transforms.qdmr_distribution import qdmr_program_encoding, load_qdmr_dataset_distribution
 from qdmr_transforms.qdmr_example import get_transform_base_info
 from qdmr_transforms.utils import extract_ref_idx
 
@@ -21,9 +21,9 @@ class TransformFilter:
         if "operator_dist_threshold" in filters:
             assert operator_dist_threshold >= 0 and operator_dist_threshold <= 100
         if qdmr_data:
-            qdmr_dist = qdmr_dataset_distribution(qdmr_data)
-            self.data_programs = qdmr_dist["programs"]
-            self.data_operators = qdmr_dist["operators"]
+            qdmr_dist = load_qdmr_dataset_distribution(qdmr_data)
+            self.data_programs = set(qdmr_dist["programs"])
+            self.data_operators = set(qdmr_dist["operators"])
             self.op_distribution = qdmr_dist["distribution"]
             self.op_threshold = operator_dist_threshold
         self.filter_programs = "data_programs" in filters
@@ -1,13 +1,19 @@
+import json
+import os
 import pandas as pd
 from typing import Dict
-from csv import DictWriter
+from csv import DictReader, DictWriter
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from tqdm import tqdm
 
 from qdmr_transforms.qdmr_transformations import *
 from qdmr_transforms.transformation_filters import *
 from qdmr_transforms.utils import load_json
-from qdmr_transforms.qdmr_example import \
-    get_transform_from_example_id, get_transform_base_info, get_transform_base_info_parts
+from qdmr_transforms.qdmr_identifier import parse_cache_info
+from qdmr_transforms.question_transformation import parse_questions, HOW_MANY_TRIGGER
+from qdmr_transforms.qdmr_example import QDMRExample, parse_transformed_id
+from src.hash_utils import file_content_hash
 
 
 def read_qdmr_data(csv_file):
@@ -19,96 +25,336 @@ def read_qdmr_example(example: Dict[str, str]):
     return QDMRExample(example['question_id'], example['question_text'], example['decomposition'])
 
 
+AUGMENTED_QS_SUFFIX = "_augmented_qs.csv"
+RAW_TRANSFORMS_SUFFIX = "_raw.csv"
+CHECKPOINT_SUFFIX = ".checkpoint.json"
+FIELD_NAMES = ['id', 'question', 'decomposition', 'transformation', 'type', 'transformed_question']
+# transformed qdmr columns in the final output file
+TRANSFORM_FIELD_NAMES = ['id', 'question', 'decomposition', 'transformation', 'type']
+# generated decomposition-question pairs, should match the break data format (csv)
+AUGMENTED_FIELD_NAMES = ['question_id', 'question_text', 'decomposition', 'operators', 'split']
+
+
+class TransformationsSink:
+    """
+    Streaming CSV sink for transformed QDMRs.
+    Keeps a single handle open per output file, buffers rows, removes duplicate rows on the fly
+    and writes both the filtered transformations file and the augmented questions file in one pass.
+    """
+
+    def __init__(self, output_file, dataset_name, buffer_size=1000):
+        self.output_file = output_file
+        self.augmented_file = output_file.replace(".csv", AUGMENTED_QS_SUFFIX)
+        self.dataset_name = dataset_name
+        self.buffer_size = buffer_size
+        self.seen_rows = set()
+        self.transform_rows = []
+        self.augmented_rows = []
+        self.total_with_duplicates = 0
+        self.total_no_duplicates = 0
+        self.total_after_filter = 0
+        self.total_augmented = 0
+        self._transform_file = None
+        self._augmented_file = None
+        self._transform_writer = None
+        self._augmented_writer = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        self._transform_file = open(self.output_file, mode='w', newline='', encoding='utf-8')
+        self._augmented_file = open(self.augmented_file, mode='w', newline='', encoding='utf-8')
+        self._transform_writer = DictWriter(self._transform_file, fieldnames=TRANSFORM_FIELD_NAMES,
+                                            extrasaction='ignore', lineterminator='\n')
+        self._augmented_writer = DictWriter(self._augmented_file, fieldnames=AUGMENTED_FIELD_NAMES,
+                                            lineterminator='\n')
+        self._transform_writer.writeheader()
+        self._augmented_writer.writeheader()
+
+    def write_row(self, row_dict):
+        self.total_with_duplicates += 1
+        row_key = tuple(row_dict[field] for field in FIELD_NAMES)
+        if row_key in self.seen_rows:
+            return False
+        self.seen_rows.add(row_key)
+        self.total_no_duplicates += 1
+
+        # keep the generated decomposition-question pairs that were created for
+        # augmenting the data used to train the question generation model.
+        if row_dict['transformed_question']:
+            self.augmented_rows.append({
+                'question_id': row_dict['id'],
+                'question_text': row_dict['transformed_question'],
+                'decomposition': row_dict['transformation'],
+                'operators': "",
+                'split': row_dict['id'].split('_', 2)[1]
+            })
+
+        # keep only transformations that result in high-quality examples (based on a manual quality-analysis)
+        if 'transform_base' not in row_dict:
+            row_dict.update(parse_transformed_id(row_dict['id']))
+        if not is_bad_parsed_transformation(row_dict['transform_base'], row_dict['transform_info_parts'],
+                                            self.dataset_name):
+            self.transform_rows.append(row_dict)
+
+        if len(self.transform_rows) + len(self.augmented_rows) >= self.buffer_size:
+            self.flush()
+        return True
+
+    def write_rows(self, rows):
+        return sum([self.write_row(row_dict) for row_dict in rows])
+
+    def flush(self):
+        self._transform_writer.writerows(self.transform_rows)
+        self._augmented_writer.writerows(self.augmented_rows)
+        self.total_after_filter += len(self.transform_rows)
+        self.total_augmented += len(self.augmented_rows)
+        self.transform_rows = []
+        self.augmented_rows = []
+
+    def close(self):
+        if self._transform_file is None:
+            return
+        self.flush()
+        self._transform_file.close()
+        self._augmented_file.close()
+        self._transform_file = None
+        self._augmented_file = None
+
+
+class ResumableTransformationsSink:
+    """
+    Checkpointed CSV sink for transformed QDMRs.
+    Appends the (unfiltered) rows of every completed chunk to a raw transformations file, and records
+    the number of input examples handled so far in a checkpoint file, so an interrupted run can continue
+    from the last completed chunk. Duplicate removal and filtering run once, over the combined raw file,
+    when the sink is finalized.
+    The checkpoint also records the run info (the input file hash and the arguments that change the output),
+    and a checkpoint of a different run is not resumed.
+    """
+
+    def __init__(self, output_file, dataset_name, run_info=None):
+        self.output_file = output_file
+        self.dataset_name = dataset_name
+        self.raw_file = output_file.replace(".csv", RAW_TRANSFORMS_SUFFIX)
+        self.checkpoint_file = output_file + CHECKPOINT_SUFFIX
+        self.run_info = run_info
+        self.checkpoint = {"examples_done": 0, "last_question_id": None,
+                           "raw_file_size": None, "written": 0, "invalid": 0, "run_info": run_info}
+        self._raw_file = None
+        self._raw_writer = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def load_checkpoint(self, records):
+        """Return the number of input examples (of records) handled by previous runs.
+        Raises a ValueError if the checkpoint is of a different run, or of different input records."""
+        if os.path.exists(self.checkpoint_file) and os.path.exists(self.raw_file):
+            with open(self.checkpoint_file, "r") as fd:
+                checkpoint = json.load(fd)
+            self.verify_checkpoint(checkpoint, records)
+            self.checkpoint = checkpoint
+        return self.checkpoint["examples_done"]
+
+    def verify_checkpoint(self, checkpoint, records):
+        def mismatch(reason):
+            return ValueError(f"Cannot resume from {self.checkpoint_file}: {reason}. "
+                              f"Remove it (and {self.raw_file}) to start over.")
+
+        if checkpoint.get("run_info") != self.run_info:
+            raise mismatch(f"it is of a different run ({checkpoint.get('run_info')}, "
+                           f"while this run is {self.run_info})")
+        examples_done = checkpoint["examples_done"]
+        if examples_done > len(records):
+            raise mismatch(f"{examples_done} examples are done, but the input has only {len(records)}")
+        if examples_done > 0 and records[examples_done - 1]['question_id'] != checkpoint["last_question_id"]:
+            raise mismatch(f"the last done example is {checkpoint['last_question_id']}, "
+                           f"but example {examples_done} of the input is {records[examples_done - 1]['question_id']}")
+
+    def open(self):
+        if self.checkpoint["raw_file_size"] is None:
+            self._raw_file = open(self.raw_file, mode='w', newline='', encoding='utf-8')
+            self._raw_writer = DictWriter(self._raw_file, fieldnames=FIELD_NAMES,
+                                          extrasaction='ignore', lineterminator='\n')
+            self._raw_writer.writeheader()
+            self.save_checkpoint()
+        else:
+            # drop the rows of a chunk that was partially written when the previous run stopped
+            with open(self.raw_file, mode='r+b') as fd:
+                fd.truncate(self.checkpoint["raw_file_size"])
+            self._raw_file = open(self.raw_file, mode='a', newline='', encoding='utf-8')
+            self._raw_writer = DictWriter(self._raw_file, fieldnames=FIELD_NAMES,
+                                          extrasaction='ignore', lineterminator='\n')
+
+    def write_chunk(self, rows, chunk, invalid):
+        self._raw_writer.writerows(rows)
+        self.checkpoint["examples_done"] += len(chunk)
+        self.checkpoint["last_question_id"] = chunk[-1]['question_id'] if chunk else \
+            self.checkpoint["last_question_id"]
+        self.checkpoint["written"] += len(rows)
+        self.checkpoint["invalid"] += invalid
+        self.save_checkpoint()
+
+    def save_checkpoint(self):
+        self._raw_file.flush()
+        os.fsync(self._raw_file.fileno())
+        self.checkpoint["raw_file_size"] = self._raw_file.tell()
+        tmp_checkpoint_file = self.checkpoint_file + ".tmp"
+        with open(tmp_checkpoint_file, "w") as fd:
+            json.dump(self.checkpoint, fd)
+        os.replace(tmp_checkpoint_file, self.checkpoint_file)
+
+    def close(self):
+        if self._raw_file is None:
+            return
+        self._raw_file.close()
+        self._raw_file = None
+
+    def finalize(self):
+        """Remove duplicates from the combined raw file and filter it into the output files.
+        Returns the TransformationsSink that wrote the output files."""
+        self.close()
+        with open(self.raw_file, mode='r', newline='', encoding='utf-8') as fd, \
+                TransformationsSink(self.output_file, self.dataset_name) as sink:
+            sink.write_rows(DictReader(fd))
+        os.remove(self.checkpoint_file)
+        os.remove(self.raw_file)
+        return sink
+
+
 def apply_qdmr_transformations(input_file, output_file, dataset_name,
                                transformations=None, filters=None, limit=None,
                                limit_append_boolean_step_per_qdmr=-1,
-                               numeric_qa_file=None):
+                               numeric_qa_file=None, workers=1, chunk_size=500, resume=False):
+    """Transform the QDMRs in input_file and write them to output_file (and the augmented questions file).
+    With resume=True, the run is checkpointed after every chunk, and continues from the checkpoint
+    of a previous run with the same output_file (if there is one), as long as it is of the same input file
+    and arguments."""
     qdmr_data = read_qdmr_data(input_file)
     qdmr_data = qdmr_data[:limit] if (limit is not None) else qdmr_data
     numeric_qa_data = load_json(numeric_qa_file) if numeric_qa_file is not None else None
+    transform_filter = None
     if filters:
         assert set(filters).issubset(set(TRANSFORM_FILTERS))
         transform_filter = TransformFilter(filters, \
                                            qdmr_data=input_file, \
                                            operator_dist_threshold=0.15)
-    with open(output_file, mode='w', encoding='utf-8') as csv_file:
-        field_names = ['id','question','decomposition','transformation', 'type', 'transformed_question']
-        writer = DictWriter(csv_file, fieldnames=field_names)
-        writer.writeheader()
+    # split the input into chunks of independent examples. chunks are processed either in-process or
+    # by a pool of worker processes, and their results are merged in the input order.
+    records = qdmr_data.to_dict("records")
+    resumable_sink = None
+    examples_done = 0
+    if resume:
+        run_info = {
+            "input_hash": file_content_hash(input_file),
+            "limit": limit,
+            "limit_append_boolean_step_per_qdmr": limit_append_boolean_step_per_qdmr,
+            "filters": sorted(filters) if filters else None,
+            "numeric_qa_hash": file_content_hash(numeric_qa_file) if numeric_qa_file is not None else None,
+        }
+        resumable_sink = ResumableTransformationsSink(output_file, dataset_name, run_info=run_info)
+        examples_done = resumable_sink.load_checkpoint(records)
+        if examples_done > 0:
+            print(f"Resuming after {examples_done} examples "
+                  f"(last question id: {resumable_sink.checkpoint['last_question_id']}).")
+        records = records[examples_done:]
+    chunks = [records[i:i + chunk_size] for i in range(0, len(records), chunk_size)]
+    transform_chunk = partial(transform_qdmr_chunk,
+                              transformations=transformations,
+                              transform_filter=transform_filter,
+                              limit_append_boolean_step_per_qdmr=limit_append_boolean_step_per_qdmr,
+                              numeric_qa_data=numeric_qa_data)
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    chunks_results = executor.map(transform_chunk, chunks) if executor is not None else map(transform_chunk, chunks)
+
     written = 0
     invalid = 0
-    for i in tqdm(range(len(qdmr_data)), desc="Loading…", ascii=False, ncols=75):
-#         qdmr_example = read_qdmr_example(qdmr_data.iloc[i])
-#         written += write_qdmr_transformations(qdmr_example,\
-#                                               output_file,\
-#                                               field_names,\
-#                                               transformations=transformations)
+    progress = tqdm(total=examples_done + len(records), initial=examples_done,
+                    desc="Loading…", ascii=False, ncols=75)
+    try:
+        if resumable_sink is not None:
+            with resumable_sink:
+                for chunk, (rows, chunk_invalid) in zip(chunks, chunks_results):
+                    resumable_sink.write_chunk(rows, chunk, chunk_invalid)
+                    progress.update(len(chunk))
+        else:
+            with TransformationsSink(output_file, dataset_name) as sink:
+                for chunk, (rows, chunk_invalid) in zip(chunks, chunks_results):
+                    sink.write_rows(rows)
+                    written += len(rows)
+                    invalid += chunk_invalid
+                    progress.update(len(chunk))
+    finally:
+        progress.close()
+        if executor is not None:
+            executor.shutdown()
+
+    if resumable_sink is not None:
+        sink = resumable_sink.finalize()
+        written = resumable_sink.checkpoint["written"]
+        invalid = resumable_sink.checkpoint["invalid"]
+
+    print(f"Ignored {invalid} invalid QDMR transformations.")
+    print(f"Overall, generated {written} QDMR transformations.")
+    print(f"After duplicate removal ({sink.total_with_duplicates-sink.total_no_duplicates}) and "
+          f"dropping bad transformations ({sink.total_no_duplicates-sink.total_after_filter}), "
+          f"wrote {sink.total_after_filter} QDMR transformations to file.")
+    print(f"Wrote {sink.total_augmented} generated questions for augmentation to file.")
+    if executor is None:
+        print(f"QDMR parse cache: {parse_cache_info()}")
+    print("Complete.")
+
+    return True
+
+
+def transform_qdmr_chunk(chunk, transformations=None, transform_filter=None,
+                         limit_append_boolean_step_per_qdmr=-1,
+                         numeric_qa_data=None):
+    """Return the rows of all transformed QDMRs of a chunk of input examples (in order),
+    and the number of invalid QDMRs in the chunk."""
+    rows = []
+    invalid = 0
+    # parse the questions of the chunk that may be transformed to boolean questions at once
+    parse_questions([example['question_text'] for example in chunk
+                     if isinstance(example['question_text'], str)
+                     and HOW_MANY_TRIGGER in example['question_text'].lower()])
+    for example in chunk:
+        qdmr_example = None
         try:
-            qdmr_example = read_qdmr_example(qdmr_data.iloc[i])
+            qdmr_example = read_qdmr_example(example)
             if qdmr_example.is_valid_qdmr() is False:
                 invalid += 1
                 print("* Invalid example: ", qdmr_example.qdmr)
                 continue
-            written += write_qdmr_transformations(qdmr_example,\
-                                                  output_file,\
-                                                  field_names,\
+            rows += get_qdmr_transformations_rows(qdmr_example,\
                                                   transformations=transformations,\
                                                   transform_filter=transform_filter, \
                                                   limit_append_boolean_step_per_qdmr=limit_append_boolean_step_per_qdmr,
                                                   numeric_qa_data=numeric_qa_data)
         except:
-            print("* Error with example: ", qdmr_example.qdmr)
+            print("* Error with example: ", example['question_id'],
+                  qdmr_example.qdmr if qdmr_example is not None else example['decomposition'])
             continue
-
-    # remove duplicates from output CSV
-    df = pd.read_csv(output_file)
-    total_with_duplicates = len(df)
-    df.drop_duplicates(subset=None, inplace=True)
-
-    # write the generated decomposition-question pairs that were created for
-    # augmenting the data used to train the question generation model.
-    df_augmented_cols = [
-        "id", "transformed_question", "transformation"
-    ]  # should match the break data format (csv)
-    df_augmented = df[df_augmented_cols][~df.transformed_question.isna()]
-    df_augmented.rename(columns={
-        "id": "question_id",
-        "transformed_question": "question_text",
-        "transformation": "decomposition"
-    }, inplace=True)
-    df_augmented["operators"] = ""
-    df_augmented["split"] = df["id"].apply(lambda x: x.split('_', 2)[1])
-    df_augmented.to_csv(output_file.replace(".csv", "_augmented_qs.csv"), index=False)
-    total_augmented = len(df_augmented)
-
-    # now filter the generated transformations to keep only transformations
-    # that result in high-quality examples (based on a manual quality-analysis)
-    total_no_duplicates = len(df)
-    df["to_drop"] = df.id.apply(lambda x: is_bad_transformation(x, dataset_name))
-    df_filtered = df[~df.to_drop]
-
-    df_transform_cols = [
-        "id", "question", "decomposition", "transformation", "type"
-    ]
-    df_filtered[df_transform_cols].to_csv(output_file, index=False)
-    total_after_filter = len(df_filtered)
-
-    print(f"Ignored {invalid} invalid QDMR transformations.")
-    print(f"Overall, generated {written} QDMR transformations.")
-    print(f"After duplicate removal ({total_with_duplicates-total_no_duplicates}) and "
-          f"dropping bad transformations ({total_no_duplicates-total_after_filter}), "
-          f"wrote {total_after_filter} QDMR transformations to file.")
-    print(f"Wrote {total_augmented} generated questions for augmentation to file.")
-    print("Complete.")
-
-    return True
+    return rows, invalid
 
 
 def is_bad_transformation(example_id, dataset_name):
-    transformation = get_transform_from_example_id(example_id)
-    transform_base, transform_info = get_transform_base_info(transformation)
-    transform_info_parts = get_transform_base_info_parts(transform_info)
+    parsed_id = parse_transformed_id(example_id)
+    return is_bad_parsed_transformation(parsed_id['transform_base'], parsed_id['transform_info_parts'],
+                                        dataset_name)
+
 
+def is_bad_parsed_transformation(transform_base, transform_info_parts, dataset_name):
     if dataset_name in ["drop", "iirc", "hotpotqa", "break"]:
         if transform_base == "op_replace_aggregate":
             return True
@@ -131,10 +377,10 @@ def is_bad_transformation(example_id, dataset_name):
     return False
 
 
-def write_qdmr_transformations(qdmr_example, output_file, field_names,
-                               transformations, transform_filter=None,
-                               limit_append_boolean_step_per_qdmr=-1,
-                               numeric_qa_data=None):
+def get_qdmr_transformations_rows(qdmr_example,
+                                  transformations, transform_filter=None,
+                                  limit_append_boolean_step_per_qdmr=-1,
+                                  numeric_qa_data=None):
     if transformations is not None:
         # TODO: handle subset of transformation
         x = 1
@@ -159,6 +405,7 @@ def write_qdmr_transformations(qdmr_example, output_file, field_names,
     if transform_filter:
         # filter out problematic transformations
         transformations = list(filter(lambda example: (not transform_filter.filter_out(example)), transformations))
+    rows = []
     for trans_example in transformations:
         row_dict = {}
         row_dict['id'] = trans_example.example_id
@@ -167,15 +414,7 @@ def write_qdmr_transformations(qdmr_example, output_file, field_names,
         row_dict['transformation'] = trans_example.qdmr
         row_dict['type'] = trans_example.transform
         row_dict['transformed_question'] = trans_example.transformed_question
-        # write results
-        append_dict_as_row(output_file, row_dict, field_names)
-    return len(transformations)
-
-
-def append_dict_as_row(file_name, dict_of_elem, field_names):
-    # Open file in append mode
-    with open(file_name, 'a+', newline='', encoding='utf-8') as write_obj:
-        # Create a writer object from csv module
-        dict_writer = DictWriter(write_obj, fieldnames=field_names)
-        # Add dictionary as wor in the csv
-        dict_writer.writerow(dict_of_elem)
+        # parse the id once, so the rows can be filtered without splitting it again
+        row_dict.update(parse_transformed_id(trans_example.example_id))
+        rows.append(row_dict)
+    return rows
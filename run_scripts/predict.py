@@ -47,6 +47,15 @@ def run(args):
         ]
     )
 
+    if args.quantize:
+        if args.gpu != "-1":
+            raise ValueError("--quantize is supported only on CPU (--gpu -1)")
+        # allennlp predict loads the archive by itself, so it is given a loader that also quantizes the model
+        import allennlp.commands.predict
+        from src.models.quantization import load_quantized_archive
+
+        allennlp.commands.predict.load_archive = load_quantized_archive
+
     print(sys.argv)
     print(" ".join(sys.argv))
     run_main()
@@ -62,6 +71,8 @@ def main():
     parse.add_argument("--model", type=str, help="model.tar.gz", required=True)
     parse.add_argument("--data", type=str, help="data path", required=True)
     parse.add_argument("-o", "--overrides", type=str, default="{}", help="Overrides")
+    parse.add_argument("--quantize", action="store_true", default=False,
+                       help="apply int8 dynamic quantization to the Linear layers of the model (CPU only)")
     args = parse.parse_args()
     return run(args)
 
@@ -0,0 +1,141 @@
+import json
+import logging
+import os
+from typing import Any, Dict
+
+from allennlp.common.file_utils import cached_path
+from allennlp_models.rc.dataset_readers.utils import split_tokens_by_hyphen
+
+from src.data.dataset_readers.drop import DropReader
+from src.data.dataset_readers.hotpotqa import HotpotQASQuADReader
+from src.hash_utils import file_content_hash
+
+logger = logging.getLogger(__name__)
+
+QA_INDEX_SUFFIX = ".qa_index.json"
+QA_INDEX_VERSION = 1
+
+
+def _passage_numbers(reader, passage_text):
+    """The numbers in the passage, as the "original_numbers" metadata of the reader's drop-format instances"""
+    passage_tokens = reader._tokenizer.tokenize(passage_text)
+    passage_tokens = split_tokens_by_hyphen(passage_tokens)
+    if reader.passage_length_limit is not None:
+        passage_tokens = passage_tokens[: reader.passage_length_limit]
+    numbers_in_passage = []
+    for token in passage_tokens:
+        number = reader.convert_word_to_number(token.text)
+        if number is not None:
+            numbers_in_passage.append(number)
+    # hack to guarantee minimal length of padded number
+    numbers_in_passage.append(0)
+    return numbers_in_passage
+
+
+def _iterate_drop_questions(dataset):
+    for passage_id, passage_info in dataset.items():
+        passage_text = passage_info["passage"]
+        for question_answer in passage_info["qa_pairs"]:
+            answer_annotations = []
+            if "answer" in question_answer:
+                answer_annotations.append(question_answer["answer"])
+            if "validated_answers" in question_answer:
+                answer_annotations += question_answer["validated_answers"]
+            yield passage_id, passage_text, question_answer["query_id"], question_answer["question"], \
+                answer_annotations
+
+
+def _iterate_hotpotqa_questions(dataset):
+    for page in dataset["data"]:
+        title = page["title"]
+        for paragraph_idx, paragraph in enumerate(page["paragraphs"]):
+            passage_id = f"{title}_{paragraph_idx}"
+            for question_answer in paragraph["qas"]:
+                if "NEGATIVE" in question_answer["id"]:
+                    continue
+                yield passage_id, paragraph["context"], question_answer["id"], question_answer["question"], \
+                    list(question_answer.get("answers", []))
+
+
+def build_qa_index(file_path: str, dataset_name: str) -> Dict[str, Any]:
+    """
+    Read the raw dataset file once, and return the passages (text and numbers) and the questions
+    (question text, passage id, answer annotations and answer texts) in it.
+    The questions are keyed as in the qa pairs dicts used by run_model.py and get_example_info_for_transformed_qdmrs.py.
+    Only the passages are tokenized, to find their numbers.
+    """
+    if dataset_name in ["drop", "iirc"]:
+        reader = DropReader()
+        iterate_questions = _iterate_drop_questions
+    elif dataset_name == "hotpot-squad":
+        reader = HotpotQASQuADReader()
+        iterate_questions = _iterate_hotpotqa_questions
+    else:
+        raise ValueError(f"Unsupported dataset: {dataset_name}")
+    # drop questions ids are unique only per passage
+    just_qids = dataset_name != "drop"
+
+    with open(cached_path(file_path)) as dataset_file:
+        dataset = json.load(dataset_file)
+
+    passages = {}
+    questions = {}
+    for passage_id, passage_text, question_id, question_text, answer_annotations in iterate_questions(dataset):
+        if passage_id not in passages:
+            passages[passage_id] = {
+                "original_passage": passage_text,
+                "original_numbers": _passage_numbers(reader, passage_text),
+            }
+        answer_texts = []
+        if answer_annotations:
+            _, answer_texts = reader.extract_answer_info_from_annotation(answer_annotations[0])
+        qid = question_id if just_qids else f"{passage_id}_{question_id}"
+        questions[qid] = {
+            "passage_id": passage_id,
+            "question_id": question_id,
+            "original_question": question_text.strip(),
+            "answer_annotations": answer_annotations,
+            "answer_texts": answer_texts,
+        }
+    return {"passages": passages, "questions": questions}
+
+
+def load_qa_pairs_dict(file_path: str, dataset_name: str, index_file: str = None) -> Dict[str, Any]:
+    """
+    A lightweight replacement for the readers' get_qa_pairs_dict (with the keys run_model.py and
+    get_example_info_for_transformed_qdmrs.py use), mapping every question id to {"metadata": {...}} with
+    the passage id, question id, original passage, original question, answer annotations, answer texts
+    and original numbers.
+    The index is persisted to an index file (by default, next to the dataset file) keyed by the hash of the
+    dataset file content, and loaded from it as long as the dataset file does not change.
+    """
+    file_path = cached_path(file_path)
+    index_file = index_file if index_file is not None else file_path + QA_INDEX_SUFFIX
+    content_hash = file_content_hash(file_path)
+    index = None
+    if os.path.exists(index_file):
+        with open(index_file, "r", encoding="utf-8") as fd:
+            index = json.load(fd)
+        if index.get("content_hash") != content_hash or index.get("dataset_name") != dataset_name or \
+                index.get("version") != QA_INDEX_VERSION:
+            index = None
+        else:
+            logger.info(f"Loaded the QA index from {index_file}")
+    if index is None:
+        logger.info(f"Building the QA index of {file_path}")
+        index = build_qa_index(file_path, dataset_name)
+        index.update({"content_hash": content_hash, "dataset_name": dataset_name, "version": QA_INDEX_VERSION})
+        try:
+            tmp_index_file = index_file + ".tmp"
+            with open(tmp_index_file, "w", encoding="utf-8") as fd:
+                json.dump(index, fd, ensure_ascii=False)
+            os.replace(tmp_index_file, index_file)
+            logger.info(f"Wrote the QA index to {index_file}")
+        except OSError as e:
+            logger.warning(f"Could not write the QA index to {index_file}: {e}")
+
+    passages = index["passages"]
+    return {
+        qid: {"metadata": dict(question, **passages[question["passage_id"]])}
+        for qid, question in index["questions"].items()
+    }
@@ -11,6 +11,7 @@ from allennlp.data.dataset_readers.dataset_reader import DatasetReader
 from allennlp.data.instance import Instance
 
 from src.data.dataset_readers.base_dataset_reader import BaseDatasetReader
+from src.data.tokenizers.passage_encoding_cache import PassageEncodingCache
 from src.data.tokenizers.offset_mapping_utils import (
     get_sequence_boundaries,
     get_token_answer_span,
@@ -26,14 +27,46 @@ from src.generation import Span
 
 logger = logging.getLogger(__name__)
 
+# "first": only the first window of every (question, context) pair is tokenized and used.
+# "all": the context is split into overlapping windows (by `stride` tokens), with an instance per window.
+WINDOWS_MODES = ["first", "all"]
+
 
 @DatasetReader.register("general_squad")
 class SquadV1Reader(BaseDatasetReader):
-    def __init__(self, length_limit: int = 512, stride: int = 0, **kwargs) -> None:
+    def __init__(
+        self,
+        length_limit: int = 512,
+        stride: int = 0,
+        passage_cache_size: int = 256,
+        windows: str = "first",
+        **kwargs
+    ) -> None:
         super().__init__(**kwargs)
 
+        if windows not in WINDOWS_MODES:
+            raise ValueError(f"windows should be one of {WINDOWS_MODES}, got {windows}")
         self._length_limit = length_limit
         self._stride = stride
+        self._windows = windows
+
+        # tokenize every passage once, when many questions are asked about the same passages.
+        self._passage_cache_size = passage_cache_size
+        self._passage_encoding_cache = None
+
+    def _get_passage_encoding_cache(self) -> Optional[PassageEncodingCache]:
+        if (
+            self._passage_cache_size <= 0
+            or self._tokenizer_wrapper is None
+            or self._tokenizer_wrapper._call_kwargs
+        ):
+            return None
+        tokenizer = self._tokenizer_wrapper.tokenizer
+        if self._passage_encoding_cache is None or self._passage_encoding_cache.tokenizer is not tokenizer:
+            self._passage_encoding_cache = PassageEncodingCache(
+                tokenizer, max_length=self._length_limit, cache_size=self._passage_cache_size
+            )
+        return self._passage_encoding_cache
 
     @overrides
     def _reader_specific_init(self):
@@ -114,16 +147,30 @@ class SquadV1Reader(BaseDatasetReader):
             "yes no@@YES_NO_SEP@@" + question + ("?" if is_boolq or add_qmark else "")
         )
 
-        encoded_input = self._tokenizer_wrapper.encode(
-            modified_question,
-            context,
-            truncation="longest_first",
-            return_offsets_mapping=True,
-            return_special_tokens_mask=True,
-            return_overflowing_tokens=True,
-            max_length=self._length_limit,
-            stride=self._stride,
-        )
+        encoded_input = None
+        all_windows = self._windows == "all"
+        passage_encoding_cache = self._get_passage_encoding_cache()
+        if passage_encoding_cache is not None:
+            # the same encoding, built from the cached passage encoding (None if the question must be truncated,
+            # or if the pair overflows and all the windows are needed)
+            encoded_input = passage_encoding_cache.encode_pair(
+                modified_question, context, truncation=not all_windows
+            )
+        if encoded_input is None:
+            encoded_input = self._tokenizer_wrapper.encode(
+                modified_question,
+                context,
+                truncation="longest_first",
+                return_offsets_mapping=True,
+                return_special_tokens_mask=True,
+                return_overflowing_tokens=all_windows,
+                max_length=self._length_limit,
+                stride=self._stride if all_windows else 0,
+            )
+            if not all_windows:
+                # the first window only, in the format of the output with overflowing tokens
+                encoded_input = {key: [value] for key, value in encoded_input.items()}
+                encoded_input["overflow_to_sample_mapping"] = [0]
 
         if is_boolq:
             first_answer_start_offset = modified_question.index(answers[0])
@@ -148,7 +195,8 @@ class SquadV1Reader(BaseDatasetReader):
             )
             if instance is not None:
                 yield instance
-            break  # Don't use windows, just the first
+            if not all_windows:
+                break
 
     @overrides
     def text_to_instance(
@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+PROBE_TEXT_PAIR = ("question", "passage")
+ENCODING_KEYS = ["input_ids", "attention_mask", "token_type_ids", "offset_mapping", "special_tokens_mask"]
+
+
+class PassageEncodingCache(object):
+    """
+    Encodes (question, passage) pairs as a (fast) huggingface tokenizer does, with offsets mapping and
+    special tokens mask, but tokenizes every passage only once.
+    The pair encoding is built by concatenating the question and passage encodings (without special tokens)
+    with the special tokens of the tokenizer's pair template, which is found by encoding a probe pair.
+    Pairs longer than max_length are truncated as with truncation="longest_first", by truncating the cached
+    passage encoding. Pairs whose question would be truncated as well are not handled (`encode_pair` returns None),
+    and neither are tokenizers whose pair encoding does not follow such a template.
+    """
+
+    def __init__(self, tokenizer, max_length: int, cache_size: int = 256):
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.cache_size = cache_size
+        self._passages: "OrderedDict[str, Dict[str, List[Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.template = self._find_template()
+
+    def _encode(self, text: str) -> Dict[str, List[Any]]:
+        encoded = self.tokenizer(
+            text,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_special_tokens_mask=True,
+        )
+        return {key: list(value) for key, value in encoded.items()}
+
+    def _find_template(self) -> Optional[Dict[str, Any]]:
+        """Return the special tokens before, between and after the pair sequences,
+        or None if the pair encoding is not a concatenation of them and the sequences."""
+        question, passage = PROBE_TEXT_PAIR
+        try:
+            pair = self.tokenizer(
+                question, passage, return_offsets_mapping=True, return_special_tokens_mask=True
+            )
+            question_ids = self._encode(question)["input_ids"]
+            passage_ids = self._encode(passage)["input_ids"]
+        except Exception:
+            return None
+        pair = {key: list(value) for key, value in pair.items()}
+        if not set(pair.keys()).issubset(ENCODING_KEYS):
+            return None
+
+        special_tokens_mask = pair["special_tokens_mask"]
+        question_start = special_tokens_mask.index(0) if 0 in special_tokens_mask else len(special_tokens_mask)
+        question_end = question_start + len(question_ids)
+        passage_start = question_end
+        while passage_start < len(special_tokens_mask) and special_tokens_mask[passage_start] == 1:
+            passage_start += 1
+        passage_end = passage_start + len(passage_ids)
+        if pair["input_ids"][question_start:question_end] != question_ids or \
+                pair["input_ids"][passage_start:passage_end] != passage_ids or \
+                any(mask != 1 for mask in special_tokens_mask[passage_end:]):
+            return None
+
+        segments = {
+            "prefix": (0, question_start),
+            "middle": (question_end, passage_start),
+            "suffix": (passage_end, len(special_tokens_mask)),
+        }
+        template = {
+            name: {key: pair[key][start:end] for key in pair.keys()}
+            for name, (start, end) in segments.items()
+        }
+        if "token_type_ids" in pair:
+            template["question_type_id"] = pair["token_type_ids"][question_start]
+            template["passage_type_id"] = pair["token_type_ids"][passage_start]
+        template["keys"] = list(pair.keys())
+        return template
+
+    def encode_passage(self, passage: str) -> Dict[str, List[Any]]:
+        if passage in self._passages:
+            self.hits += 1
+            self._passages.move_to_end(passage)
+            return self._passages[passage]
+        self.misses += 1
+        encoded = self._encode(passage)
+        self._passages[passage] = encoded
+        if len(self._passages) > self.cache_size:
+            self._passages.popitem(last=False)
+        return encoded
+
+    def encode_pair(
+        self, question: str, passage: str, truncation: bool = True
+    ) -> Optional[Dict[str, List[Any]]]:
+        """Return the pair encoding, in the format of the tokenizer output with overflowing tokens
+        (i.e. a list of windows per key, with a single window), or None if it cannot be built.
+        A pair longer than max_length is truncated to its first window, or is not handled if truncation=False
+        (e.g. when all the overflowing windows are needed)."""
+        template = self.template
+        if template is None:
+            return None
+        encoded_question = self._encode(question)
+        encoded_passage = self.encode_passage(passage)
+        num_special_tokens = sum(len(template[name]["input_ids"]) for name in ["prefix", "middle", "suffix"])
+        max_pair_length = self.max_length - num_special_tokens
+        num_question_tokens = len(encoded_question["input_ids"])
+        if num_question_tokens + len(encoded_passage["input_ids"]) > max_pair_length:
+            # longest_first truncates only the passage (the longest sequence) as long as it is still
+            # at least as long as the question
+            if not truncation or 2 * num_question_tokens > max_pair_length:
+                return None
+            encoded_passage = {
+                key: value[:max_pair_length - num_question_tokens] for key, value in encoded_passage.items()
+            }
+
+        encoded_input = {}
+        for key in template["keys"]:
+            if key == "token_type_ids":
+                question_values = [template["question_type_id"]] * len(encoded_question["input_ids"])
+                passage_values = [template["passage_type_id"]] * len(encoded_passage["input_ids"])
+            elif key == "attention_mask":
+                question_values = [1] * len(encoded_question["input_ids"])
+                passage_values = [1] * len(encoded_passage["input_ids"])
+            else:
+                question_values = encoded_question[key]
+                passage_values = encoded_passage[key]
+            encoded_input[key] = [
+                template["prefix"][key] + question_values + template["middle"][key] +
+                passage_values + template["suffix"][key]
+            ]
+        encoded_input["overflow_to_sample_mapping"] = [0]
+        return encoded_input
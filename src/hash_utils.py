@@ -0,0 +1,13 @@
+import hashlib
+
+
+def file_content_hash(file_path: str) -> str:
+    sha = hashlib.sha256()
+    with open(file_path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(2 ** 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
@@ -0,0 +1,108 @@
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_TIMEOUT = 60.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class QAServerClient(object):
+    """
+    Client of a QA model server (the `/predict` endpoint at the given port), that sends up to
+    `concurrency` requests at once over persistent (keep-alive) connections.
+    Requests that time out, fail to connect or get a retryable status code are retried up to `max_retries`
+    times, waiting `backoff * 2 ** attempt` seconds before each retry.
+    """
+
+    def __init__(
+        self,
+        port: int,
+        host: str = "localhost",
+        concurrency: int = DEFAULT_CONCURRENCY,
+        timeout: float = DEFAULT_TIMEOUT,
+        max_retries: int = DEFAULT_MAX_RETRIES,
+        backoff: float = DEFAULT_BACKOFF,
+    ):
+        self.url = f"http://{host}:{port}/predict"
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.num_requests = 0
+        self.num_retries = 0
+        self._stats_lock = threading.Lock()
+        # every worker thread has its own session (requests sessions are not thread-safe)
+        self._local = threading.local()
+        self._sessions = []
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def _get_session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.headers.update({'content-type': 'application/json'})
+            self._local.session = session
+            with self._stats_lock:
+                self._sessions.append(session)
+        return session
+
+    def _post(self, payload):
+        session = self._get_session()
+        for attempt in range(self.max_retries + 1):
+            with self._stats_lock:
+                self.num_requests += 1
+                if attempt > 0:
+                    self.num_retries += 1
+            try:
+                response = session.post(self.url, data=json.dumps(payload), timeout=self.timeout)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.json()
+                error = requests.HTTPError(f"{response.status_code} from {self.url}", response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt == self.max_retries:
+                raise error
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def get_answer(self, question: str, paragraphs: List[str]) -> Any:
+        """Same as get_answer in run_model.py with a server port: the answer for the last paragraph."""
+        answer = None
+        for paragraph in paragraphs:
+            payload = {
+                "passage": paragraph,
+                "question": question + " yes no"
+            }
+            response = self._post(payload)
+            answer = response["answer"]["value"]
+        return answer
+
+    def _get_answer_or_error(self, question_paragraphs):
+        question, paragraphs = question_paragraphs
+        try:
+            return self.get_answer(question, paragraphs)
+        except Exception as e:
+            return e
+
+    def get_answers(self, questions_paragraphs: List[Tuple[str, List[str]]]) -> List[Any]:
+        """Returns the answers of the (question, paragraphs) pairs in their order, sending the requests
+        concurrently. If answering a question raised an error, the exception is returned as its answer."""
+        return list(self._executor.map(self._get_answer_or_error, questions_paragraphs))
+
+    def stats(self):
+        return {"requests": self.num_requests, "retries": self.num_retries}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for session in self._sessions:
+            session.close()
@@ -24,17 +24,21 @@ def is_ref_in_decomposition(ref, decomposition_step):
     return len(get_ref_pos_in_decomposition_step(ref, decomposition_step)) > 0
 
 
+def answer_to_text(step_answer):
+    if type(step_answer) == str:
+        return step_answer
+    elif type(step_answer) == list:
+        # this happens when the answer is multi-span
+        return ';'.join(step_answer)
+    else:
+        raise RuntimeError
+
+
 def fill_in_references(decomposition_step, step_answers):
     for i in range(MAX_STEPS - 1, -1, -1):
         ref = _index_to_reference(i)
         if i < len(step_answers) and step_answers[i] is not None:
-            if type(step_answers[i]) == str:
-                step_answer = step_answers[i]
-            elif type(step_answers[i]) == list:
-                # this happens when the answer is multi-span
-                step_answer = ';'.join(step_answers[i])
-            else:
-                raise RuntimeError
+            step_answer = answer_to_text(step_answers[i])
             pos = get_ref_pos_in_decomposition_step(ref, decomposition_step)
             for j in pos[::-1]:
                 decomposition_step = decomposition_step[:j] + step_answer + decomposition_step[j+len(ref):]
@@ -77,3 +81,108 @@ def get_reachability(decomposition):
             return None
         reachability += step_reachability
     return reachability
+
+
+def get_reference_positions(decomposition_step):
+    """Return the (position, step index) of every reference in the decomposition step, ordered by position"""
+    positions = []
+    for i in range(MAX_STEPS):
+        ref = _index_to_reference(i)
+        positions.extend((j, i) for j in get_ref_pos_in_decomposition_step(ref, decomposition_step))
+    return sorted(positions)
+
+
+class ExecutionPlan(object):
+    """
+    The references between the steps of a decomposition, parsed once:
+    the references of every step, the steps that reference every step (dependents),
+    the topological level of every step (the length of the longest reference chain from it),
+    and every step split into text segments and references, to fill in answers without re-parsing it.
+    Equivalent to calling get_reachability and fill_in_references on the decomposition in every iteration.
+    """
+
+    def __init__(self, decomposition):
+        self.num_steps = len(decomposition)
+        self.segments = []
+        self.references = []
+        for step in decomposition:
+            segments = []
+            last_end = 0
+            for pos, i in get_reference_positions(step):
+                segments.append(step[last_end:pos])
+                segments.append(i)
+                last_end = pos + len(_index_to_reference(i))
+            segments.append(step[last_end:])
+            self.segments.append(segments)
+            self.references.append(sorted(set(segment for segment in segments if type(segment) == int)))
+
+        # the plan is not executable if a step references itself, or if a reference chain is too long
+        # (or cyclic). A reference to a step that does not exist is an error.
+        self.is_executable = True
+        self.error = None
+        for i, refs in enumerate(self.references):
+            if i in refs:
+                self.is_executable = False
+                break
+            out_of_range = [ref for ref in refs if ref >= self.num_steps]
+            if out_of_range:
+                self.error = IndexError(
+                    f"step {i + 1} references {_index_to_reference(out_of_range[0])}, "
+                    f"but there are {self.num_steps} steps"
+                )
+                break
+        if self.error is not None or not self.is_executable:
+            self.dependents = None
+            self.levels = None
+            self.required_steps = None
+            return
+
+        self.dependents = [[] for _ in range(self.num_steps)]
+        for i, refs in enumerate(self.references):
+            for ref in refs:
+                self.dependents[ref].append(i)
+
+        self.levels = self._get_levels()
+        if self.levels is None or (self.levels and max(self.levels) >= MAX_STEPS):
+            self.is_executable = False
+            self.required_steps = None
+            return
+
+        # the steps that the last step depends on (including by proxy)
+        required = set()
+        stack = list(self.references[-1]) if self.num_steps > 0 else []
+        while stack:
+            i = stack.pop()
+            if i not in required:
+                required.add(i)
+                stack.extend(self.references[i])
+        self.required_steps = sorted(required)
+
+    def _get_levels(self):
+        """Return the topological level of every step, or None if the references are cyclic"""
+        levels = [None] * self.num_steps
+        num_unleveled_refs = [len(refs) for refs in self.references]
+        current_level = [i for i, refs in enumerate(self.references) if len(refs) == 0]
+        for i in current_level:
+            levels[i] = 0
+        while current_level:
+            next_level = []
+            for ref in current_level:
+                for i in self.dependents[ref]:
+                    num_unleveled_refs[i] -= 1
+                    if num_unleveled_refs[i] == 0:
+                        levels[i] = max(levels[j] for j in self.references[i]) + 1
+                        next_level.append(i)
+            current_level = next_level
+        if any(level is None for level in levels):
+            return None
+        return levels
+
+    def fill_in_references(self, i, step_answers):
+        """Return step i with the references to answered steps replaced by their answers"""
+        return "".join(
+            segment if type(segment) == str
+            else answer_to_text(step_answers[segment]) if step_answers[segment] is not None
+            else _index_to_reference(segment)
+            for segment in self.segments[i]
+        )
@@ -0,0 +1,104 @@
+import json
+import time
+from contextlib import contextmanager
+from typing import Any, Dict
+
+
+class MetricsRegistry(object):
+    """
+    Counters, value distributions (e.g. batch sizes) and timers of a run of the iterative QA stage.
+    A timer is a distribution of durations in seconds.
+    The summary of a registry can be merged into another one (e.g. of worker processes into the main process).
+    """
+
+    def __init__(self):
+        self.counters: Dict[str, float] = {}
+        self.distributions: Dict[str, Dict[str, float]] = {}
+        self.start_time = time.perf_counter()
+        self._last_log_time = self.start_time
+
+    def increment(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float):
+        distribution = self.distributions.get(name)
+        if distribution is None:
+            self.distributions[name] = {"count": 1, "sum": value, "min": value, "max": value}
+        else:
+            distribution["count"] += 1
+            distribution["sum"] += value
+            distribution["min"] = min(distribution["min"], value)
+            distribution["max"] = max(distribution["max"], value)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def hit_rates(self) -> Dict[str, float]:
+        """The hit rate of every pair of "X_hits" and "X_misses" counters"""
+        hit_rates = {}
+        for name, hits in self.counters.items():
+            if name.endswith("_hits"):
+                lookups = hits + self.counters.get(name[:-len("_hits")] + "_misses", 0)
+                if lookups > 0:
+                    hit_rates[name[:-len("_hits")]] = hits / lookups
+        return hit_rates
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "elapsed_seconds": time.perf_counter() - self.start_time,
+            "counters": dict(self.counters),
+            "hit_rates": self.hit_rates(),
+            "distributions": {
+                name: dict(distribution, mean=distribution["sum"] / distribution["count"])
+                for name, distribution in self.distributions.items()
+            },
+        }
+
+    def merge(self, summary: Dict[str, Any]):
+        """Add the counters and distributions of the summary of another registry"""
+        for name, value in summary["counters"].items():
+            self.increment(name, value)
+        for name, other in summary["distributions"].items():
+            distribution = self.distributions.get(name)
+            if distribution is None:
+                self.distributions[name] = {key: other[key] for key in ["count", "sum", "min", "max"]}
+            else:
+                distribution["count"] += other["count"]
+                distribution["sum"] += other["sum"]
+                distribution["min"] = min(distribution["min"], other["min"])
+                distribution["max"] = max(distribution["max"], other["max"])
+
+    def reset(self):
+        self.__init__()
+
+    def log_line(self) -> str:
+        parts = [f"{name}={value:g}" for name, value in sorted(self.counters.items())]
+        parts += [
+            f"{name}: n={distribution['count']} mean={distribution['sum'] / distribution['count']:.4g}"
+            for name, distribution in sorted(self.distributions.items())
+        ]
+        return f"[metrics after {time.perf_counter() - self.start_time:.0f}s] " + ", ".join(parts)
+
+    def maybe_log(self, logger, every_seconds: float):
+        """Log the metrics if at least every_seconds passed since the last time (never, if it is not positive)"""
+        if every_seconds <= 0:
+            return
+        now = time.perf_counter()
+        if now - self._last_log_time >= every_seconds:
+            self._last_log_time = now
+            logger.info(self.log_line())
+
+    def write(self, metrics_file: str, extra: Dict[str, Any] = None):
+        summary = self.summary()
+        summary.update(extra or {})
+        with open(metrics_file, "w", encoding="utf-8") as fd:
+            json.dump(summary, fd, indent=4)
+
+
+# the metrics of the current process
+metrics = MetricsRegistry()
@@ -1,8 +1,14 @@
 import torch
+import cProfile
+import heapq
 import json
 import logging
+import multiprocessing
+import os
+import queue
 import requests
 import time
+import traceback
 from copy import deepcopy
 from typing import Optional
 
@@ -13,93 +19,433 @@ from allennlp.training.metrics import BooleanAccuracy
 
 from tqdm import tqdm
 
-from src.data.dataset_readers.drop import DropReader
-from src.data.dataset_readers.hotpotqa import HotpotQASQuADReader
+from src.data.dataset_readers.qa_index import load_qa_pairs_dict
 from src.data.dataset_readers.transformed_qdmrs import read_qdmrs
+from src.hash_utils import file_content_hash
+from src.models.iterative.run_metrics import metrics
+from src.models.iterative.qa_server_client import (
+    QAServerClient,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_TIMEOUT,
+    DEFAULT_MAX_RETRIES,
+)
+from src.models.quantization import load_quantized_archive
+from src.models.qa.onnx_qa_model import use_onnx_qa_model
+from src.predictors.transformer_qa import DEFAULT_MAX_BATCH_TOKENS
+from src.models.iterative.step_answer_cache import (
+    StepAnswerCache, DEFAULT_MAX_ENTRIES, model_archive_hash
+)
 from src.models.iterative.reference_utils import (
-    fill_in_references,
-    get_reachability,
+    MAX_STEPS,
+    ExecutionPlan,
+    answer_to_text,
     has_reference,
 )
 
 logger = logging.getLogger(__name__)
 
+JSONL_SUFFIX = ".jsonl"
+
 wh_words = ["what", "which", "who", "where", "when"]
 
 
-def run_model_on_qdmr(qdmr, qa_pairs, predictor, q_gen_predictor, predictor_port, max_loops=10):
-    instance = qa_pairs[qdmr["orig_qid"]]
-    used_decomposition = deepcopy(qdmr["transformed"])
-    if q_gen_predictor is not None:
-        # Use the question generation model to transform decomposition steps without references into questions.
-        # For steps that include references, use simple heuristics.
-        for i in range(len(used_decomposition)):
-            used_decomposition[i] = get_step_question(
-                q_gen_predictor=q_gen_predictor,
-                decomposition_step=used_decomposition[i]
-            )
-
-    # Per instance:
-    # Until the final step has an answer, find in each iteration
-    # all of the steps that are required to answer the last step (including by proxy)
-    # and don't have references in them.
-    # If it is not possible, return a score of zero for the instance.
-    # If it is possible, retrieve paragraphs for these steps,
-    # and then pass the step and the paragraphs for it to be answered by the model.
-    # Replace the answer in all of the steps that has a reference for it.
-
-    step_answers = [None for i in range(len(used_decomposition))]
-    loop_count = 0
-    while True:
+class QDMRExecution(object):
+    """
+    The state of answering the steps of a single QDMR.
+    Per instance:
+    Until the final step has an answer, find in each iteration
+    all of the steps that are required to answer the last step (including by proxy)
+    and don't have references in them.
+    If it is not possible, return a score of zero for the instance.
+    If it is possible, retrieve paragraphs for these steps,
+    and then pass the step and the paragraphs for it to be answered by the model.
+    Replace the answer in all of the steps that has a reference for it.
+    """
+
+    def __init__(self, qdmr, qa_pairs, q_gen_predictor, max_loops=10, step_questions=None):
+        self.qdmr = qdmr
+        self.instance = qa_pairs[qdmr["orig_qid"]]
+        self.max_loops = max_loops
+        self.used_decomposition = deepcopy(qdmr["transformed"])
+        if q_gen_predictor is not None or step_questions is not None:
+            # Use the question generation model to transform decomposition steps without references into questions.
+            # For steps that include references, use simple heuristics.
+            for i in range(len(self.used_decomposition)):
+                self.used_decomposition[i] = get_step_question(
+                    q_gen_predictor=q_gen_predictor,
+                    decomposition_step=self.used_decomposition[i],
+                    step_questions=step_questions,
+                )
+        self.step_answers = [None for i in range(len(self.used_decomposition))]
+        self.loop_count = 0
+        # the references of the steps are parsed once, and resolved as the steps are answered
+        self.plan = ExecutionPlan(self.used_decomposition)
+        self.pending_references = [set(refs) for refs in self.plan.references]
+
+    @property
+    def paragraphs(self):
+        return [self.instance['metadata']["original_passage"]]
+
+    def ready_steps(self):
+        """Return the indices of the steps to answer in the next iteration, or None when done."""
         # safety check that we don't run into an infinite loop.
-        loop_count += 1
-        if loop_count >= max_loops:
-            print(f"[-] reached maximum number of loop iterations: {qdmr['qid']}")
-            break
-
-        reachability = get_reachability([step for step in used_decomposition])
-        if reachability is None:
-            break
-
-        if step_answers[-1] is not None:
+        self.loop_count += 1
+        if self.loop_count >= self.max_loops:
+            print(f"[-] reached maximum number of loop iterations: {self.qdmr['qid']}")
+            metrics.increment("qdmr.max_loops_bailouts")
+            return None
+
+        if self.plan.error is not None:
+            raise self.plan.error
+        if not self.plan.is_executable:
+            return None
+
+        if self.step_answers[-1] is not None:
+            return None
+
+        # steps that the last step depends on, are not answered, and have no unanswered references.
+        # answered steps only depend on answered steps, so these are exactly the steps reachable from the
+        # last step through unanswered references.
+        if self.pending_references[-1]:
+            return [
+                i for i in self.plan.required_steps
+                if self.step_answers[i] is None and not self.pending_references[i]
+            ]
+        return [len(self.step_answers) - 1]
+
+    def set_answers(self, indices, answers):
+        """Set the answers of the given steps, and replace the references to them in all steps."""
+        for i, answer in zip(indices, answers):
+            self.step_answers[i] = answer
+
+        answered = [i for i in indices if self.step_answers[i] is not None]
+        for i in answered:
+            if i < MAX_STEPS:
+                answer_to_text(self.step_answers[i])  # raises for answers that cannot be filled in
+        for i in sorted(set(dependent for i in answered for dependent in self.plan.dependents[i])):
+            self.pending_references[i].difference_update(answered)
+            self.used_decomposition[i] = self.plan.fill_in_references(i, self.step_answers)
+
+    def output(self):
+        return {
+            "qid": self.qdmr["qid"],
+            "orig_qid": self.qdmr["orig_qid"],
+            "passage": self.instance['metadata']["original_passage"],
+            "question": self.instance['metadata']["original_question"],
+            "transformed_decomposition": self.qdmr["transformed"],
+            "transformed_evaluated": [step for step in self.used_decomposition],
+            "step_answers": self.step_answers,
+        }
+
+
+def run_model_on_qdmr(qdmr, qa_pairs, predictor, q_gen_predictor, predictor_port, max_loops=10,
+                      step_questions=None):
+    execution = QDMRExecution(qdmr, qa_pairs, q_gen_predictor, max_loops=max_loops, step_questions=step_questions)
+    while True:
+        indices_of_interest = execution.ready_steps()
+        if indices_of_interest is None:
+            metrics.observe("qdmr.loop_iterations", execution.loop_count - 1)
             break
 
-        indices_of_interest = []
-        if (sum(reachability[-1])) != 0:
-            for i, reachable in enumerate(reachability[-1]):
-                if reachable > 0 and sum(reachability[i]) == 0:
-                    indices_of_interest.append(i)
-        else:
-            indices_of_interest.append(len(step_answers) - 1)
-
-        for i in indices_of_interest:
-            step_answers[i] = get_answer(
+        answers = [
+            get_answer(
                 predictor=predictor,
-                question=used_decomposition[i],
-                paragraphs=[instance['metadata']["original_passage"]],
+                question=execution.used_decomposition[i],
+                paragraphs=execution.paragraphs,
                 force_yes_no=False,
                 predictor_port=predictor_port,
             )  # Return the best non-empty answer
-
-        for i, step in enumerate(used_decomposition):
-            used_decomposition[i] = fill_in_references(
-                step, step_answers
-            )
-
-    output_json_obj = {
-        "qid": qdmr["qid"],
-        "orig_qid": qdmr["orig_qid"],
-        "passage": instance['metadata']["original_passage"],
-        "question": instance['metadata']["original_question"],
-        "transformed_decomposition": qdmr["transformed"],
-        "transformed_evaluated": [step for step in used_decomposition],
-        "step_answers": step_answers,
+            for i in indices_of_interest
+        ]
+        execution.set_answers(indices_of_interest, answers)
+
+    return execution.output()
+
+
+def run_model_on_qdmrs(qdmrs, qa_pairs, predictor, q_gen_predictor, predictor_port,
+                       qa_batch_size=32, max_in_flight=256, max_loops=10, step_answer_cache=None,
+                       step_questions=None, qa_server_client=None):
+    """
+    Same as calling run_model_on_qdmr on every QDMR, but keeps up to max_in_flight QDMRs in flight,
+    and answers the ready steps of all of them (steps whose references are all resolved) in QA batches.
+    With a QA server client, the ready steps are sent to the QA server concurrently instead.
+    Yields (qdmr index, output) pairs in the order of the input QDMRs. QDMRs that raised an error are skipped.
+    """
+    pending = iter(enumerate(qdmrs))
+    in_flight = []
+    outputs = {}
+    next_output_index = 0
+    exhausted = False
+    while in_flight or not exhausted:
+        # refill the QDMRs in flight
+        while not exhausted and len(in_flight) < max_in_flight:
+            qdmr_i, qdmr = next(pending, (None, None))
+            if qdmr is None:
+                exhausted = True
+                break
+            try:
+                execution = QDMRExecution(qdmr, qa_pairs, q_gen_predictor,
+                                          max_loops=max_loops, step_questions=step_questions)
+                in_flight.append((qdmr_i, execution))
+            except Exception as e:
+                print(f"error for {qdmr['qid']}: {e}")
+                metrics.increment("qdmr.errors")
+                outputs[qdmr_i] = None
+
+        # gather the ready steps of all the QDMRs in flight
+        wavefront = []
+        still_in_flight = []
+        for qdmr_i, execution in in_flight:
+            try:
+                indices_of_interest = execution.ready_steps()
+            except Exception as e:
+                print(f"error for {execution.qdmr['qid']}: {e}")
+                metrics.increment("qdmr.errors")
+                outputs[qdmr_i] = None
+                continue
+            if indices_of_interest is None:
+                metrics.increment("qdmr.finished")
+                metrics.observe("qdmr.loop_iterations", execution.loop_count - 1)
+                outputs[qdmr_i] = execution.output()
+            else:
+                wavefront.append((qdmr_i, execution, indices_of_interest))
+                still_in_flight.append((qdmr_i, execution))
+        in_flight = still_in_flight
+
+        # answer the ready steps in batches, and scatter the answers back
+        step_answers = get_batch_answers(
+            predictor=predictor,
+            questions_paragraphs=[
+                (execution.used_decomposition[i], execution.paragraphs)
+                for _, execution, indices_of_interest in wavefront
+                for i in indices_of_interest
+            ],
+            force_yes_no=False,
+            predictor_port=predictor_port,
+            batch_size=qa_batch_size,
+            step_answer_cache=step_answer_cache,
+            qa_server_client=qa_server_client,
+        )
+        failed = set()
+        for qdmr_i, execution, indices_of_interest in wavefront:
+            answers = step_answers[:len(indices_of_interest)]
+            step_answers = step_answers[len(indices_of_interest):]
+            try:
+                errors = [answer for answer in answers if isinstance(answer, Exception)]
+                if errors:
+                    raise errors[0]
+                execution.set_answers(indices_of_interest, answers)
+            except Exception as e:
+                print(f"error for {execution.qdmr['qid']}: {e}")
+                metrics.increment("qdmr.errors")
+                outputs[qdmr_i] = None
+                failed.add(qdmr_i)
+        in_flight = [(qdmr_i, execution) for qdmr_i, execution in in_flight if qdmr_i not in failed]
+
+        # yield the finished outputs in the input order
+        while next_output_index in outputs:
+            output = outputs.pop(next_output_index)
+            if output is not None:
+                yield next_output_index, output
+            next_output_index += 1
+
+
+def get_passage_shards(qdmrs, qa_pairs, num_shards):
+    """
+    Split the QDMRs into num_shards shards (lists of QDMR indices, in the input order),
+    such that all the QDMRs of a passage are in the same shard, and the shards have similar numbers of steps.
+    """
+    passage_qdmr_indices = {}
+    for qdmr_i, qdmr in enumerate(qdmrs):
+        passage = qa_pairs[qdmr["orig_qid"]]['metadata']["original_passage"]
+        passage_qdmr_indices.setdefault(passage, []).append(qdmr_i)
+
+    # assign the passages with the most steps first, each to the shard with the least steps so far
+    passage_groups = sorted(
+        passage_qdmr_indices.values(),
+        key=lambda qdmr_indices: -sum(len(qdmrs[qdmr_i]["transformed"]) for qdmr_i in qdmr_indices)
+    )
+    shard_loads = [(0, shard_i) for shard_i in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for qdmr_indices in passage_groups:
+        load, shard_i = heapq.heappop(shard_loads)
+        shards[shard_i].extend(qdmr_indices)
+        heapq.heappush(shard_loads, (load + sum(len(qdmrs[qdmr_i]["transformed"]) for qdmr_i in qdmr_indices),
+                                     shard_i))
+    return [sorted(shard) for shard in shards if shard]
+
+
+def get_qa_runtime(quantize, qa_onnx_path):
+    """The runtime of the QA model, if it is not the PyTorch model of the archive
+    (an exported model is identified by the hash of its file, as it depends on the opset and exporter)"""
+    if qa_onnx_path is not None:
+        return f"onnx:{file_content_hash(qa_onnx_path)}"
+    return "dynamic_int8" if quantize else None
+
+
+def load_qa_predictor(qa_model_path, gpu, overrides, quantize, qa_onnx_path, max_batch_tokens, num_threads=None):
+    """Loads the QA predictor of the archive, with its QA transformer run by onnxruntime from qa_onnx_path,
+    or quantized (if requested)."""
+    load_qa_archive = load_quantized_archive if quantize and qa_onnx_path is None else load_archive
+    archive = load_qa_archive(qa_model_path, cuda_device=gpu, overrides=overrides)
+    if qa_onnx_path is not None:
+        use_onnx_qa_model(archive.model, qa_onnx_path, num_threads=num_threads)
+    predictor = Predictor.from_archive(archive)
+    predictor.max_batch_tokens = max_batch_tokens
+    return predictor
+
+
+def run_shard(shard_i, qdmr_indices, qdmrs, qa_pairs, config, output_queue):
+    """
+    Worker process of run_model_on_qdmrs_sharded: loads the QA model, and runs it on the QDMRs of the shard.
+    Puts ("output", qdmr index, output or None if the QDMR raised an error) for every QDMR on the queue,
+    and then ("done", shard index, {"step_answer_cache": stats, "metrics": metrics summary}),
+    or ("error", shard index, traceback).
+    With a profile_file in the config, the shard runs under cProfile and dumps its stats to that file.
+    """
+    profiler = None
+    if config["profile_file"] is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        torch.set_num_threads(config["torch_threads"])
+        import_module_and_submodules("src")
+        predictor = load_qa_predictor(config["qa_model_path"], config["gpu"], config["overrides"],
+                                      config["quantize"], config["qa_onnx_path"], config["qa_max_batch_tokens"],
+                                      num_threads=config["torch_threads"])
+        step_answer_cache = None
+        if config["step_answer_cache_path"] is not None:
+            step_answer_cache = StepAnswerCache(config["step_answer_cache_path"], config["qa_model_hash"],
+                                                max_entries=config["step_answer_cache_size"])
+
+        next_local_i = 0
+        outputs = run_model_on_qdmrs(qdmrs, qa_pairs, predictor, None, 0,
+                                     qa_batch_size=config["qa_batch_size"], max_in_flight=config["max_in_flight"],
+                                     step_answer_cache=step_answer_cache, step_questions=config["step_questions"])
+        for local_i, output in outputs:
+            # QDMRs that raised an error have no output
+            for skipped_i in range(next_local_i, local_i):
+                output_queue.put(("output", qdmr_indices[skipped_i], None))
+            output_queue.put(("output", qdmr_indices[local_i], output))
+            next_local_i = local_i + 1
+        for skipped_i in range(next_local_i, len(qdmr_indices)):
+            output_queue.put(("output", qdmr_indices[skipped_i], None))
+
+        stats = None
+        if step_answer_cache is not None:
+            stats = step_answer_cache.stats()
+            step_answer_cache.close()
+        record_passage_encoding_cache_metrics(predictor)
+        output_queue.put(("done", shard_i, {"step_answer_cache": stats, "metrics": metrics.summary()}))
+    except Exception:
+        output_queue.put(("error", shard_i, traceback.format_exc()))
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(config["profile_file"])
+
+
+def get_shard_profile_file(profile_file, shard_i):
+    return f"{profile_file}.shard{shard_i}" if profile_file is not None else None
+
+
+def run_model_on_qdmrs_sharded(qdmrs, qa_pairs, qa_model_path, num_workers, torch_threads=None, gpu=-1,
+                               overrides="{}", qa_batch_size=32, max_in_flight=256, step_questions=None,
+                               step_answer_cache_path=None, step_answer_cache_size=DEFAULT_MAX_ENTRIES,
+                               quantize=False, qa_max_batch_tokens=DEFAULT_MAX_BATCH_TOKENS, qa_onnx_path=None,
+                               profile_file=None):
+    """
+    Same as run_model_on_qdmrs, but with num_workers worker processes, each loading the QA model and
+    using torch_threads threads (by default, the number of CPUs divided by num_workers).
+    The QDMRs are sharded by passage, and the outputs of the shards are merged in the order of the input QDMRs.
+    With a profile_file, every worker is profiled to its own stats file, profile_file.shard<i>.
+    """
+    if torch_threads is None:
+        torch_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    shards = get_passage_shards(qdmrs, qa_pairs, num_workers)
+    config = {
+        "qa_model_path": qa_model_path,
+        "qa_model_hash": model_archive_hash(qa_model_path, overrides, get_qa_runtime(quantize, qa_onnx_path))
+        if step_answer_cache_path is not None else None,
+        "gpu": gpu,
+        "overrides": overrides,
+        "quantize": quantize,
+        "qa_onnx_path": qa_onnx_path,
+        "qa_max_batch_tokens": qa_max_batch_tokens,
+        "torch_threads": torch_threads,
+        "qa_batch_size": qa_batch_size,
+        "max_in_flight": max_in_flight,
+        "step_answer_cache_path": step_answer_cache_path,
+        "step_answer_cache_size": step_answer_cache_size,
     }
-
-    return output_json_obj
-
-
-def get_step_question(q_gen_predictor, decomposition_step):
+    logger.info(f"Running {len(shards)} shard workers with {torch_threads} torch threads each, "
+                f"shard sizes: {[len(shard) for shard in shards]}")
+
+    context = multiprocessing.get_context("spawn")
+    output_queue = context.Queue()
+    processes = []
+    for shard_i, qdmr_indices in enumerate(shards):
+        shard_qdmrs = [qdmrs[qdmr_i] for qdmr_i in qdmr_indices]
+        # only what the QDMR executions use from the original instances, and the questions of the shard steps
+        shard_qa_pairs = {
+            qdmr["orig_qid"]: {"metadata": {
+                "original_passage": qa_pairs[qdmr["orig_qid"]]['metadata']["original_passage"],
+                "original_question": qa_pairs[qdmr["orig_qid"]]['metadata']["original_question"],
+            }}
+            for qdmr in shard_qdmrs
+        }
+        shard_config = dict(config)
+        shard_config["profile_file"] = get_shard_profile_file(profile_file, shard_i)
+        shard_config["step_questions"] = None if step_questions is None else {
+            step: step_questions[step]
+            for qdmr in shard_qdmrs for step in qdmr["transformed"] if step in step_questions
+        }
+        process = context.Process(
+            target=run_shard,
+            args=(shard_i, qdmr_indices, shard_qdmrs, shard_qa_pairs, shard_config, output_queue),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+
+    outputs = {}
+    next_output_index = 0
+    done_shards = set()
+    try:
+        while next_output_index < len(qdmrs) or len(done_shards) < len(shards):
+            try:
+                message = output_queue.get(timeout=5)
+            except queue.Empty:
+                for shard_i, process in enumerate(processes):
+                    if shard_i not in done_shards and not process.is_alive():
+                        raise RuntimeError(f"shard worker {shard_i} exited with code {process.exitcode}")
+                continue
+            kind, key, value = message
+            if kind == "output":
+                outputs[key] = value
+            elif kind == "done":
+                done_shards.add(key)
+                metrics.merge(value["metrics"])
+                if value["step_answer_cache"] is not None:
+                    logger.info(f"Step answer cache of shard {key}: {value['step_answer_cache']}")
+            else:
+                raise RuntimeError(f"shard worker {key} failed:\n{value}")
+
+            # yield the finished outputs in the input order
+            while next_output_index in outputs:
+                output = outputs.pop(next_output_index)
+                if output is not None:
+                    yield next_output_index, output
+                next_output_index += 1
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+
+def get_step_question(q_gen_predictor, decomposition_step, step_questions=None):
     # if the decomposition step includes references - use heuristics.
     if has_reference(decomposition_step):
         question = None
@@ -116,8 +462,14 @@ def get_step_question(q_gen_predictor, decomposition_step):
                 question = "what is the " + decomposition_step
 
     # if the decomposition step do not include references - use the question generation model.
+    elif step_questions is not None and decomposition_step in step_questions:
+        metrics.increment("q_gen.step_questions_hits")
+        question = step_questions[decomposition_step]
     else:
-        result = q_gen_predictor.predict(decomposition_step)
+        if step_questions is not None:
+            metrics.increment("q_gen.step_questions_misses")
+        with metrics.timer("q_gen.call_seconds"):
+            result = q_gen_predictor.predict(decomposition_step)
         question = result["questions"][0][0]
 
     # make sure the question ends with a question mark.
@@ -127,7 +479,52 @@ def get_step_question(q_gen_predictor, decomposition_step):
     return question
 
 
+def get_reference_free_steps(qdmrs):
+    """Return the distinct decomposition steps without references of all the QDMRs"""
+    return list(dict.fromkeys(
+        step for qdmr in qdmrs for step in qdmr["transformed"] if not has_reference(step)
+    ))
+
+
+def generate_step_questions(q_gen_predictor, decomposition_steps, batch_size=32):
+    """Map every decomposition step to the question generated for it by the question generation model,
+    running the model on batches of steps of similar lengths."""
+    step_questions = {}
+    decomposition_steps = sorted(decomposition_steps, key=len)
+    for batch_start in tqdm(range(0, len(decomposition_steps), batch_size), desc="generating step questions"):
+        batch = decomposition_steps[batch_start:batch_start + batch_size]
+        metrics.observe("q_gen.batch_size", len(batch))
+        with metrics.timer("q_gen.batch_seconds"):
+            results = q_gen_predictor.predict_batch_json([{"decomposition_str": step} for step in batch])
+        for step, result in zip(batch, results):
+            step_questions[step] = result["questions"][0][0]
+    return step_questions
+
+
+def load_step_questions(step_questions_path, q_gen_model_hash):
+    """Load the persisted step questions, if they were generated by the same question generation model"""
+    if step_questions_path is None or not os.path.exists(step_questions_path):
+        return {}
+    with open(step_questions_path, "r", encoding="utf-8") as f:
+        persisted = json.load(f)
+    if persisted["q_gen_model_hash"] != q_gen_model_hash:
+        logger.info(f"Ignoring step questions of a different question generation model: {step_questions_path}")
+        return {}
+    return persisted["step_questions"]
+
+
+def save_step_questions(step_questions_path, q_gen_model_hash, step_questions):
+    with open(step_questions_path, "w", encoding="utf-8") as f:
+        json.dump({"q_gen_model_hash": q_gen_model_hash, "step_questions": step_questions},
+                  f, ensure_ascii=False, indent=4)
+
+
 def get_answer(predictor, question, paragraphs, force_yes_no, predictor_port):
+    with metrics.timer("qa.call_seconds"):
+        return _get_answer(predictor, question, paragraphs, force_yes_no, predictor_port)
+
+
+def _get_answer(predictor, question, paragraphs, force_yes_no, predictor_port):
     max_score = float("-inf")
     answer = None
     for paragraph in paragraphs:
@@ -164,6 +561,150 @@ def get_answer(predictor, question, paragraphs, force_yes_no, predictor_port):
     return answer
 
 
+def get_batch_answers(predictor, questions_paragraphs, force_yes_no, predictor_port, batch_size=32,
+                      step_answer_cache=None, qa_server_client=None):
+    """
+    Same as calling get_answer on every (question, paragraphs) pair, but runs the QA model on batches of
+    batch_size questions. Returns the answers in the order of the pairs. If answering a question raised
+    an error, the exception is returned as its answer.
+    Predictions found in the step answer cache (if given) are not recomputed, and new ones are added to it.
+    Without a predictor, the questions are sent to the QA server (through qa_server_client, if given).
+    """
+    if predictor is None and qa_server_client is not None:
+        metrics.observe("qa.server_batch_size", len(questions_paragraphs))
+        with metrics.timer("qa.server_batch_seconds"):
+            return qa_server_client.get_answers(questions_paragraphs)
+    if predictor is None:
+        answers = []
+        for question, paragraphs in questions_paragraphs:
+            try:
+                answers.append(get_answer(predictor, question, paragraphs, force_yes_no, predictor_port))
+            except Exception as e:
+                answers.append(e)
+        return answers
+
+    # one input per (question, paragraph) pair, the answer is the best scoring one over the paragraphs.
+    inputs = [
+        (question_i, {"context": paragraph, "question": question})
+        for question_i, (question, paragraphs) in enumerate(questions_paragraphs)
+        for paragraph in paragraphs
+    ]
+    # the (best span score, best span string) prediction of every input
+    predictions = [None for _ in inputs]
+    answers = [None for _ in questions_paragraphs]
+
+    inputs_to_predict = list(range(len(inputs)))
+    if step_answer_cache is not None:
+        keys = [step_answer_cache.key(json_dict["question"], json_dict["context"], force_yes_no)
+                for _, json_dict in inputs]
+        cached = step_answer_cache.get_many(keys)
+        metrics.increment("qa.step_answer_cache_hits", sum([key in cached for key in keys]))
+        metrics.increment("qa.step_answer_cache_misses", sum([key not in cached for key in keys]))
+        # identical inputs that are not cached are predicted once
+        key_to_input_i = {}
+        for input_i, key in enumerate(keys):
+            if key in cached:
+                predictions[input_i] = cached[key]
+            else:
+                key_to_input_i.setdefault(key, input_i)
+        inputs_to_predict = list(key_to_input_i.values())
+
+    for batch_start in range(0, len(inputs_to_predict), batch_size):
+        batch = inputs_to_predict[batch_start:batch_start + batch_size]
+        metrics.observe("qa.batch_size", len(batch))
+        try:
+            with metrics.timer("qa.batch_seconds"):
+                batch_results = predict_batch_json(predictor, [inputs[input_i][1] for input_i in batch],
+                                                   force_yes_no)
+        except Exception:
+            metrics.increment("qa.batch_failures")
+            # predict the inputs of the batch one by one, so an error only fails the question that raised it
+            batch_results = []
+            for input_i in batch:
+                try:
+                    batch_results += predict_batch_json(predictor, [inputs[input_i][1]], force_yes_no)
+                except Exception as e:
+                    predictions[input_i] = e
+                    batch_results.append(None)
+        for input_i, result in zip(batch, batch_results):
+            if result is not None:
+                predictions[input_i] = (result["best_span_scores"], result["best_span_str"])
+        if step_answer_cache is not None:
+            step_answer_cache.put_many({
+                keys[input_i]: predictions[input_i] for input_i in batch
+                if not isinstance(predictions[input_i], Exception)
+            })
+
+    if step_answer_cache is not None:
+        for input_i, key in enumerate(keys):
+            if predictions[input_i] is None:
+                predictions[input_i] = predictions[key_to_input_i[key]]
+
+    max_scores = [float("-inf") for _ in questions_paragraphs]
+    for (question_i, _), prediction in zip(inputs, predictions):
+        if isinstance(answers[question_i], Exception):
+            continue
+        if isinstance(prediction, Exception):
+            answers[question_i] = prediction
+            continue
+        best_span_scores, best_span_str = prediction
+        if max_scores[question_i] < best_span_scores:
+            max_scores[question_i] = best_span_scores
+            answers[question_i] = best_span_str
+    return answers
+
+
+def predict_batch_json(predictor, json_dicts, force_yes_no):
+    """Returns the predictions for the json inputs, in their order (all the instances of an input,
+    one per passage window, are predicted in the same batch and grouped by their question id)."""
+    instances = []
+    qids = []
+    with metrics.timer("qa.tokenization_seconds"):
+        for json_dict in json_dicts:
+            json_instances = predictor._batch_json_to_instances([json_dict])
+            instances.extend(json_instances)
+            qids.append(json_instances[0]["metadata"]["id"])
+    metrics.observe("qa.instances_per_batch", len(instances))
+    with metrics.timer("qa.inference_seconds"):
+        results = predictor.predict_batch_instance(
+            instances, allow_null=False, force_yes_no=force_yes_no
+        )
+    qid_to_result = {result["id"]: result for result in results}
+    return [qid_to_result[qid] for qid in qids]
+
+
+def record_passage_encoding_cache_metrics(predictor):
+    """Add the hits and misses of the passage encoding cache of the QA dataset reader (if any) to the metrics"""
+    reader = getattr(predictor, "_dataset_reader", None)
+    passage_encoding_cache = getattr(reader, "_passage_encoding_cache", None)
+    if passage_encoding_cache is not None:
+        metrics.increment("qa.passage_encoding_cache_hits", passage_encoding_cache.hits)
+        metrics.increment("qa.passage_encoding_cache_misses", passage_encoding_cache.misses)
+
+
+def load_output_qids(output_predictions_file):
+    """Return the qids of the outputs in a (possibly partially written) JSONL output predictions file,
+    and truncate it after its last complete output."""
+    qids = set()
+    if not os.path.exists(output_predictions_file):
+        return qids
+    valid_size = 0
+    with open(output_predictions_file, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                qids.add(json.loads(line)["qid"])
+            except (ValueError, KeyError):
+                break
+            valid_size += len(line)
+    if valid_size < os.path.getsize(output_predictions_file):
+        logger.info(f"Truncating an incomplete output at the end of {output_predictions_file}")
+        with open(output_predictions_file, "r+b") as f:
+            f.truncate(valid_size)
+    return qids
+
+
 def main(
     gpu: int,
     qa_model_path: str,
@@ -174,57 +715,158 @@ def main(
     dataset_name: str,   # drop / hotpotqa-squad / iirc
     output_predictions_file: str,
     overrides="{}",
+    qa_batch_size: int = 32,
+    max_qdmrs_in_flight: int = 256,
+    step_answer_cache_path: Optional[str] = None,
+    step_answer_cache_size: int = DEFAULT_MAX_ENTRIES,
+    q_gen_batch_size: int = 32,
+    step_questions_path: Optional[str] = None,
+    qa_server_concurrency: int = DEFAULT_CONCURRENCY,
+    qa_server_timeout: float = DEFAULT_TIMEOUT,
+    qa_server_retries: int = DEFAULT_MAX_RETRIES,
+    flush_every: int = 100,
+    resume: bool = False,
+    num_workers: int = 1,
+    torch_threads_per_worker: Optional[int] = None,
+    metrics_file: Optional[str] = None,
+    metrics_log_every: float = 0,
+    qa_windows: Optional[str] = None,
+    quantize: bool = False,
+    qa_max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS,
+    qa_onnx_path: Optional[str] = None,
+    profile_file: Optional[str] = None,
 ):
     import_module_and_submodules("src")
 
-    # if no server port was provided, load model from archive.
+    sharded = num_workers > 1
+    qa_max_batch_tokens = qa_max_batch_tokens if qa_max_batch_tokens > 0 else None
+    if sharded and qa_model_server_port > 0:
+        raise ValueError("--num-workers requires a QA model archive (--qa-model-path), not a server")
+    if qa_onnx_path is not None and gpu >= 0:
+        raise ValueError("--qa-onnx-path runs the QA model on CPU, so it requires --gpu -1")
+
+    if qa_windows is not None:
+        # the predictor reads the passages with the validation dataset reader of the archive
+        overrides_dict = json.loads(overrides)
+        overrides_dict.setdefault("validation_dataset_reader", {})["windows"] = qa_windows
+        overrides = json.dumps(overrides_dict)
+
+    # if no server port was provided, load model from archive (in sharded mode, every worker loads it).
     predictor = None
-    if qa_model_server_port == 0:
+    if qa_model_server_port == 0 and not sharded:
         overrides_dict = {}
         overrides_dict.update(json.loads(overrides))
-        archive = load_archive(qa_model_path, cuda_device=gpu, overrides=json.dumps(overrides_dict))
-        predictor = Predictor.from_archive(archive)
-    assert predictor is not None or qa_model_server_port > 0
-
-    q_gen_predictor = None
-    if q_gen_model_path != "":
-        q_gen_archive = load_archive(q_gen_model_path, cuda_device=gpu)
-        q_gen_predictor = Predictor.from_archive(q_gen_archive, predictor_name="q_gen")
+        predictor = load_qa_predictor(qa_model_path, gpu, json.dumps(overrides_dict), quantize, qa_onnx_path,
+                                      qa_max_batch_tokens)
+    assert predictor is not None or qa_model_server_port > 0 or sharded
+
+    qa_server_client = None
+    if qa_model_server_port > 0:
+        qa_server_client = QAServerClient(qa_model_server_port, concurrency=qa_server_concurrency,
+                                          timeout=qa_server_timeout, max_retries=qa_server_retries)
+
+    # the cache is keyed by the model archive, so it is used only with a model loaded from an archive.
+    step_answer_cache = None
+    if step_answer_cache_path is not None and predictor is not None:
+        step_answer_cache = StepAnswerCache.from_archive(step_answer_cache_path, qa_model_path,
+                                                         max_entries=step_answer_cache_size, overrides=overrides,
+                                                         runtime=get_qa_runtime(quantize, qa_onnx_path))
 
     logger.info("Reading QDMRs file at %s", qdmrs_path)
     qdmrs = read_qdmrs(qdmrs_path, dataset_name)
 
-    dataset_reader = None
-    just_qids = True
-    if dataset_name in ["drop", "iirc"]:
-        dataset_reader = DropReader()
-        if dataset_name == "drop":
-            just_qids = False
-    elif dataset_name == "hotpot-squad":
-        dataset_reader = HotpotQASQuADReader()
     logger.info("Reading the dataset:")
     logger.info("Reading file at %s", orig_data_path)
-    qa_pairs = dataset_reader.get_qa_pairs_dict(args.orig_data_path, just_qids=just_qids)
+    qa_pairs = load_qa_pairs_dict(orig_data_path, dataset_name)
+
+    # this can happen in IIRC when we could generate QDMR transformations,
+    # but we dropped the question when converting into DROP format (which does not support no-answer questions).
+    # according to the IIRC paper, there are 30% of the questions cannot be answered given the provided context.
+    qdmrs = [qdmr for qdmr in qdmrs if qdmr["orig_qid"] in qa_pairs]
+
+    # a JSONL output file is written while running, so the run can be resumed after an interruption.
+    stream_output = output_predictions_file is not None and output_predictions_file.endswith(JSONL_SUFFIX)
+    if resume and not stream_output:
+        raise ValueError(f"--resume requires an output predictions file with a {JSONL_SUFFIX} suffix")
+    if resume:
+        done_qids = load_output_qids(output_predictions_file)
+        qdmrs = [qdmr for qdmr in qdmrs if qdmr["qid"] not in done_qids]
+        logger.info(f"Resuming: skipping {len(done_qids)} QDMRs that are already in {output_predictions_file}")
+
+    # generate the questions of all the distinct steps without references in advance, in batches.
+    # the question generation model is loaded only if some of them were not persisted by previous runs.
+    step_questions = None
+    if q_gen_model_path:
+        q_gen_model_hash = model_archive_hash(q_gen_model_path, runtime="dynamic_int8" if quantize else None)
+        step_questions = load_step_questions(step_questions_path, q_gen_model_hash)
+        missing_steps = [step for step in get_reference_free_steps(qdmrs) if step not in step_questions]
+        logger.info(f"Generating questions for {len(missing_steps)} steps "
+                    f"({len(step_questions)} step questions were loaded).")
+        if missing_steps:
+            load_q_gen_archive = load_quantized_archive if quantize else load_archive
+            q_gen_archive = load_q_gen_archive(q_gen_model_path, cuda_device=gpu)
+            q_gen_predictor = Predictor.from_archive(q_gen_archive, predictor_name="q_gen")
+            step_questions.update(generate_step_questions(q_gen_predictor, missing_steps, batch_size=q_gen_batch_size))
+            if step_questions_path is not None:
+                save_step_questions(step_questions_path, q_gen_model_hash, step_questions)
 
     output_dataset = []
-    for qdmr_i, qdmr in tqdm(enumerate(qdmrs)):
-        # this can happen in IIRC when we could generate QDMR transformations,
-        # but we dropped the question when converting into DROP format (which does not support no-answer questions).
-        # according to the IIRC paper, there are 30% of the questions cannot be answered given the provided context.
-        if qdmr["orig_qid"] not in qa_pairs:
-            continue
-
-        try:
-            output_json_obj = run_model_on_qdmr(qdmr, qa_pairs, predictor, q_gen_predictor, qa_model_server_port)
+    output_file = None
+    if stream_output:
+        output_file = open(output_predictions_file, "a" if resume else "w", encoding="utf-8")
+    num_outputs = 0
+    if sharded:
+        outputs = run_model_on_qdmrs_sharded(qdmrs, qa_pairs, qa_model_path, num_workers,
+                                             torch_threads=torch_threads_per_worker, gpu=gpu, overrides=overrides,
+                                             qa_batch_size=qa_batch_size, max_in_flight=max_qdmrs_in_flight,
+                                             step_questions=step_questions,
+                                             step_answer_cache_path=step_answer_cache_path,
+                                             step_answer_cache_size=step_answer_cache_size,
+                                             quantize=quantize, qa_max_batch_tokens=qa_max_batch_tokens,
+                                             qa_onnx_path=qa_onnx_path, profile_file=profile_file)
+    else:
+        outputs = run_model_on_qdmrs(qdmrs, qa_pairs, predictor, None, qa_model_server_port,
+                                     qa_batch_size=qa_batch_size, max_in_flight=max_qdmrs_in_flight,
+                                     step_answer_cache=step_answer_cache, step_questions=step_questions,
+                                     qa_server_client=qa_server_client)
+    for qdmr_i, output_json_obj in tqdm(outputs, total=len(qdmrs)):
+        num_outputs += 1
+        if output_file is not None:
+            output_file.write(json.dumps(output_json_obj, ensure_ascii=False) + "\n")
+            if num_outputs % flush_every == 0:
+                output_file.flush()
+                os.fsync(output_file.fileno())
+        else:
             output_dataset.append(output_json_obj)
-        except Exception as e:
-            print(f"error for {qdmr['qid']}: {e}")
-            continue
 
         if qdmr_i < 5:
             logger.info(output_json_obj)
-
-    if output_predictions_file is not None:
+        metrics.maybe_log(logger, metrics_log_every)
+
+    if predictor is not None:
+        record_passage_encoding_cache_metrics(predictor)
+    run_stats = {}
+
+    if step_answer_cache is not None:
+        run_stats["step_answer_cache"] = step_answer_cache.stats()
+        logger.info(f"Step answer cache: {run_stats['step_answer_cache']}")
+        step_answer_cache.close()
+
+    if qa_server_client is not None:
+        run_stats["qa_server_client"] = qa_server_client.stats()
+        logger.info(f"QA server client: {run_stats['qa_server_client']}")
+        qa_server_client.close()
+
+    logger.info(metrics.log_line())
+    if metrics_file is not None:
+        metrics.write(metrics_file, extra=run_stats)
+        logger.info(f"Metrics are at: {metrics_file}")
+
+    if output_file is not None:
+        output_file.close()
+        logger.info(f"Evaluated {num_outputs} QDMRs.")
+        logger.info(f"Output predictions are at: {output_predictions_file}")
+    elif output_predictions_file is not None:
         with open(output_predictions_file, "w", encoding="utf-8") as f:
             json.dump(output_dataset, f, ensure_ascii=False, indent=4)
             logger.info(f"Evaluated {len(output_dataset)} QDMRs.")
@@ -246,6 +888,65 @@ if __name__ == "__main__":
     parse.add_argument("--dataset-name", choices=['drop', 'hotpot-squad', 'iirc'], required=True)
     parse.add_argument("--output-predictions-file", type=str)
     parse.add_argument("-o", "--overrides", type=str, default="{}", help="Overrides")
-    args = parse.parse_args()
-
-    main(**vars(args))
+    parse.add_argument("--qa-windows", choices=["first", "all"], default=None,
+                       help="passage windows the QA model reads: only the first one (the default of the archive "
+                            "readers), or all of them, taking the best answer across windows")
+    parse.add_argument("--quantize", action="store_true",
+                       help="apply int8 dynamic quantization to the Linear layers of the QA and question generation "
+                            "models (CPU only)")
+    parse.add_argument("--qa-onnx-path", type=str, default=None,
+                       help="run the QA model with onnxruntime on CPU, from this ONNX export of the QA model "
+                            "archive (see tools/export_qa_model_to_onnx.py). --quantize then applies only to "
+                            "question generation")
+    parse.add_argument("--qa-batch-size", type=int, default=32,
+                       help="maximal number of step questions answered by the QA model in a single batch")
+    parse.add_argument("--qa-max-batch-tokens", type=int, default=DEFAULT_MAX_BATCH_TOKENS,
+                       help="the QA model runs every batch of step questions in sub-batches of similar lengths, "
+                            "with up to this number of (padded) tokens each (0 for a single sub-batch)")
+    parse.add_argument("--max-qdmrs-in-flight", type=int, default=256,
+                       help="maximal number of QDMRs whose steps are answered concurrently")
+    parse.add_argument("--step-answer-cache-path", type=str, default=None,
+                       help="path to an SQLite file caching the QA model answers to step questions across runs")
+    parse.add_argument("--step-answer-cache-size", type=int, default=DEFAULT_MAX_ENTRIES,
+                       help="maximal number of cached step answers (least recently used ones are evicted)")
+    parse.add_argument("--q-gen-batch-size", type=int, default=32,
+                       help="number of decomposition steps in a single batch of the question generation model")
+    parse.add_argument("--step-questions-path", type=str, default=None,
+                       help="path to a json file persisting the questions generated for decomposition steps across runs")
+    parse.add_argument("--qa-server-concurrency", type=int, default=DEFAULT_CONCURRENCY,
+                       help="maximal number of concurrent requests to the QA model server")
+    parse.add_argument("--qa-server-timeout", type=float, default=DEFAULT_TIMEOUT,
+                       help="timeout (in seconds) of a request to the QA model server")
+    parse.add_argument("--qa-server-retries", type=int, default=DEFAULT_MAX_RETRIES,
+                       help="number of retries (with exponential backoff) of a failed request to the QA model server")
+    parse.add_argument("--num-workers", type=int, default=1,
+                       help="number of worker processes, each loading the QA model and answering the steps "
+                            "of a shard of the QDMRs (sharded by passage)")
+    parse.add_argument("--torch-threads-per-worker", type=int, default=None,
+                       help="number of torch threads of every worker process "
+                            "(by default, the number of CPUs divided by the number of workers)")
+    parse.add_argument("--metrics-file", type=str, default=None,
+                       help="path to a json file to write a summary of the run metrics (timers, counters, "
+                            "batch sizes and cache hit rates) to")
+    parse.add_argument("--metrics-log-every", type=float, default=0,
+                       help="log the run metrics every this number of seconds (0 to log them only at the end)")
+    parse.add_argument("--profile-file", type=str, default=None,
+                       help="run under cProfile, and dump the profiling stats to this file (for pstats/snakeviz). "
+                            "With --num-workers > 1, every worker is profiled as well, to <profile-file>.shard<i>")
+    parse.add_argument("--flush-every", type=int, default=100,
+                       help="number of QDMRs between flushes of a JSONL output predictions file to disk")
+    parse.add_argument("--resume", action="store_true",
+                       help="skip the QDMRs that are already in the (JSONL) output predictions file, "
+                            "and append the outputs of the rest to it")
+    args = vars(parse.parse_args())
+
+    profile_file = args["profile_file"]
+    if profile_file is not None:
+        profiler = cProfile.Profile()
+        profiler.runcall(main, **args)
+        profiler.dump_stats(profile_file)
+        logger.info(f"Profiling stats are at: {profile_file}")
+        if args["num_workers"] > 1:
+            logger.info(f"Profiling stats of the workers are at: {profile_file}.shard<i>")
+    else:
+        main(**args)
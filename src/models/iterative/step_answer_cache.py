@@ -0,0 +1,219 @@
+import json
+import logging
+import sqlite3
+from typing import Any, Dict, List, Optional, Tuple
+
+from src.hash_utils import file_content_hash, text_hash
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1000000
+# seconds to wait for the lock of the cache file, which the shard workers share
+DEFAULT_TIMEOUT = 60.0
+# the maximal number of hits whose last use waits for the next write
+MAX_PENDING_LAST_USED = 10000
+
+
+def model_archive_hash(archive_path: str, overrides: str = "{}", runtime: Optional[str] = None) -> str:
+    """The hash of the model archive content, and of the overrides of its config and the runtime of the model,
+    e.g. "dynamic_int8" or "onnx:<hash of the exported model>" (if there are any)."""
+    model_hash = file_content_hash(archive_path)
+    overrides_dict = json.loads(overrides)
+    if overrides_dict or runtime is not None:
+        model_hash = text_hash(json.dumps(
+            [model_hash, overrides_dict] + ([runtime] if runtime is not None else []), sort_keys=True
+        ))
+    return model_hash
+
+
+def normalize_step_question(question: str) -> str:
+    # the QA model is case sensitive, so only the whitespaces are normalized.
+    return " ".join(question.split())
+
+
+class StepAnswerCache(object):
+    """
+    Persistent cache of the QA model predictions for (filled-in) step questions, stored in an SQLite file.
+    A prediction is keyed by the normalized step question, the hash of the passage, the hash of the
+    QA model archive (and its config overrides and runtime) and the prediction arguments, so cached predictions are
+    reused across runs with the same model archive. The cache holds up to max_entries predictions, and evicts the least
+    recently used ones when it grows beyond that.
+    The file may be shared by several processes (e.g. the shard workers of run_model): the table size is bounded by
+    a row count that is kept in the file and updated by every write, and a read or write that fails (e.g. the database
+    stays locked) is a miss or a skipped write. The last uses of hits are written with the next predictions.
+    """
+
+    def __init__(self, cache_path: str, model_hash: str, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.cache_path = cache_path
+        self.model_hash = model_hash
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+        # transactions are explicit, so a write takes the lock before it reads the table
+        self._connection = sqlite3.connect(cache_path, timeout=timeout, isolation_level=None)
+        # readers do not block the writer (and vice versa) in WAL mode
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS step_answers "
+            "(key TEXT PRIMARY KEY, prediction TEXT NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS step_answers_last_used ON step_answers (last_used)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS step_answers_info (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+        self._write(lambda tick: self._init_num_entries())
+        # the keys of hits whose last use is not written yet
+        self._used_keys = set()
+
+    @classmethod
+    def from_archive(
+        cls,
+        cache_path: str,
+        archive_path: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        overrides: str = "{}",
+        runtime: Optional[str] = None,
+    ):
+        return cls(cache_path, model_archive_hash(archive_path, overrides, runtime), max_entries=max_entries)
+
+    def key(self, question: str, passage: str, force_yes_no: bool) -> str:
+        return text_hash(json.dumps([
+            normalize_step_question(question), text_hash(passage), self.model_hash, force_yes_no
+        ]))
+
+    def get_many(self, keys: List[str]) -> Dict[str, Tuple[float, Any]]:
+        """Return the cached (best span score, best span string) predictions of the given keys"""
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        try:
+            # sqlite limits the number of variables in a statement
+            for start in range(0, len(unique_keys), 500):
+                batch_keys = unique_keys[start:start + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, prediction FROM step_answers WHERE key IN ({','.join('?' * len(batch_keys))})",
+                    batch_keys
+                ).fetchall()
+                found.update({key: tuple(json.loads(prediction)) for key, prediction in rows})
+        except sqlite3.Error as e:
+            self._on_error("read", e)
+            found = {}
+        self.hits += sum([key in found for key in keys])
+        self.misses += sum([key not in found for key in keys])
+        self._used_keys.update(found)
+        if len(self._used_keys) >= MAX_PENDING_LAST_USED:
+            self._flush_last_used()
+        return found
+
+    def put_many(self, predictions: Dict[str, Tuple[float, Any]]):
+        if not predictions:
+            return
+
+        def insert_and_evict(tick):
+            self._update_last_used(tick)
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO step_answers (key, prediction, last_used) VALUES (?, ?, ?)",
+                [(key, json.dumps(list(prediction)), tick) for key, prediction in predictions.items()]
+            )
+            self._add_num_entries(self._connection.total_changes - before)
+            self._evict()
+
+        try:
+            self._write(insert_and_evict)
+        except sqlite3.Error as e:
+            self._on_error("write", e)
+        # the last uses are not retried after a failed write, they only order the evictions
+        self._used_keys = set()
+
+    def _update_last_used(self, tick):
+        if self._used_keys:
+            self._connection.executemany(
+                "UPDATE step_answers SET last_used = ? WHERE key = ?",
+                [(tick, key) for key in self._used_keys]
+            )
+
+    def _init_num_entries(self):
+        """Counts the rows once per cache file (e.g. of a file written before the count was kept)"""
+        if self._get_num_entries() is None:
+            self._connection.execute(
+                "INSERT INTO step_answers_info (name, value) SELECT 'num_entries', COUNT(*) FROM step_answers"
+            )
+
+    def _get_num_entries(self) -> Optional[int]:
+        row = self._connection.execute("SELECT value FROM step_answers_info WHERE name = 'num_entries'").fetchone()
+        return row[0] if row is not None else None
+
+    def _add_num_entries(self, value: int):
+        if value != 0:
+            self._connection.execute(
+                "UPDATE step_answers_info SET value = value + ? WHERE name = 'num_entries'", (value,)
+            )
+
+    def _write(self, write_function):
+        """Runs write_function(tick) in a write transaction, where tick is later than every last use in the table
+        (of any process)."""
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            (max_last_used,) = self._connection.execute("SELECT MAX(last_used) FROM step_answers").fetchone()
+            write_function((max_last_used or 0) + 1)
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _evict(self):
+        """Evicts the least recently used entries beyond max_entries, by the row count of the cache file (which the
+        other processes of the cache file update as well). Runs inside the write transaction."""
+        num_to_evict = self._get_num_entries() - self.max_entries
+        if num_to_evict <= 0:
+            return
+        cursor = self._connection.execute(
+            "DELETE FROM step_answers WHERE key IN "
+            "(SELECT key FROM step_answers ORDER BY last_used LIMIT ?)",
+            (num_to_evict,)
+        )
+        self._add_num_entries(-cursor.rowcount)
+        self.evictions += cursor.rowcount
+
+    def _on_error(self, action: str, error: sqlite3.Error):
+        self.errors += 1
+        logger.warning(f"Failed to {action} the step answer cache {self.cache_path}: {error}")
+
+    def num_entries(self) -> Optional[int]:
+        try:
+            return self._get_num_entries()
+        except sqlite3.Error as e:
+            self._on_error("count the entries of", e)
+            return None
+
+    def hit_rate(self) -> Optional[float]:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "entries": self.num_entries(),
+            "max_entries": self.max_entries,
+        }
+
+    def _flush_last_used(self):
+        try:
+            self._write(self._update_last_used)
+        except sqlite3.Error as e:
+            self._on_error("update the last use of", e)
+        self._used_keys = set()
+
+    def close(self):
+        if self._used_keys:
+            self._flush_last_used()
+        self._connection.close()
@@ -0,0 +1,92 @@
+import inspect
+import logging
+from typing import Dict, List, Optional
+
+import torch
+
+from allennlp.models import Model
+
+logger = logging.getLogger(__name__)
+
+# the inputs and outputs of the exported QA transformer (the inputs are the ones its tokenizer returns)
+ONNX_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+ONNX_OUTPUT_NAMES = ["start_logits", "end_logits"]
+# the highest opset of torch 1.6 (which allennlp 1.1 requires). newer transformers versions need at least 14.
+DEFAULT_OPSET_VERSION = 12
+
+
+class _ExportedQAModel(torch.nn.Module):
+    """The QA transformer with positional inputs and tuple outputs, as torch.onnx.export expects."""
+
+    def __init__(self, qa_model: torch.nn.Module, input_names: List[str]):
+        super().__init__()
+        self.qa_model = qa_model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        outputs = self.qa_model(**dict(zip(self.input_names, inputs)))
+        return outputs["start_logits"], outputs["end_logits"]
+
+
+def get_input_names(model: Model) -> List[str]:
+    encoded = model._tokenizer_wrapper.tokenizer("question", "passage")
+    return [name for name in ONNX_INPUT_NAMES if name in encoded]
+
+
+def export_qa_model(model: Model, onnx_path: str, opset_version: int = DEFAULT_OPSET_VERSION):
+    """
+    Exports the QA transformer (`_qa_model`) of a transformer_qa_v2 model to an ONNX file, with dynamic batch
+    and sequence axes.
+    """
+    input_names = get_input_names(model)
+    encoded = model._tokenizer_wrapper.tokenizer(
+        ["question", "another question"], ["passage", "a longer passage"], padding=True, return_tensors="pt"
+    )
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ONNX_OUTPUT_NAMES}
+    export_kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer torch versions export with dynamo by default, which ignores dynamic_axes
+        export_kwargs["dynamo"] = False
+    # the exporter restores the training mode of the exported module (and its submodules) when it is done
+    exported_model = _ExportedQAModel(model._qa_model, input_names).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            exported_model,
+            tuple(encoded[name] for name in input_names),
+            onnx_path,
+            input_names=input_names,
+            output_names=ONNX_OUTPUT_NAMES,
+            dynamic_axes=dynamic_axes,
+            opset_version=opset_version,
+            **export_kwargs,
+        )
+    logger.info(f"Exported the QA model to {onnx_path}")
+
+
+class OnnxQAModel(torch.nn.Module):
+    """
+    Runs an exported QA transformer with onnxruntime on CPU. It takes the inputs and returns the logits of the
+    PyTorch QA transformer (`_qa_model`) of a transformer_qa_v2 model, so it can replace it.
+    """
+
+    def __init__(self, onnx_path: str, num_threads: Optional[int] = None):
+        super().__init__()
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+        self.input_names = [session_input.name for session_input in self.session.get_inputs()]
+
+    def forward(self, **inputs) -> Dict[str, torch.Tensor]:
+        feed = {name: inputs[name].cpu().numpy() for name in self.input_names}
+        start_logits, end_logits = self.session.run(ONNX_OUTPUT_NAMES, feed)
+        return {"start_logits": torch.from_numpy(start_logits), "end_logits": torch.from_numpy(end_logits)}
+
+
+def use_onnx_qa_model(model: Model, onnx_path: str, num_threads: Optional[int] = None) -> Model:
+    """Replaces the PyTorch QA transformer of a transformer_qa_v2 model with the exported one (in place)."""
+    model._qa_model = OnnxQAModel(onnx_path, num_threads=num_threads)
+    logger.info(f"Running the QA model with onnxruntime from {onnx_path}")
+    return model
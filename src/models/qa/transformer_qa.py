@@ -23,6 +23,24 @@ from src.data.tokenizers.hf_tokenizer_wrapper import HFTokenizerWrapper
 logger = logging.getLogger(__name__)
 
 
+def get_possible_answer_mask(
+    input_ids: torch.LongTensor, spans: List[Optional[torch.IntTensor]]
+) -> torch.BoolTensor:
+    """
+    Returns a mask of shape ``(batch_size, sequence_length)`` of the tokens in any of the spans of the row
+    (inclusive), ignoring spans that are None or marked (-1, -1).
+    Each of the spans is a tensor of shape ``(batch_size, 2)``, as the span fields of the model.
+    """
+    positions = torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+    possible_answer_mask = torch.zeros_like(input_ids, dtype=torch.bool)
+    for span in spans:
+        if span is None:
+            continue
+        start, end = span[:, 0:1], span[:, 1:2]
+        possible_answer_mask |= (start != -1) & (end != -1) & (positions >= start) & (positions <= end)
+    return possible_answer_mask
+
+
 @Model.register("transformer_qa_v2")
 class TransformerQA(Model):
     """
@@ -133,28 +151,16 @@ class TransformerQA(Model):
             string from the original passage that the model thinks is the best answer to the
             question.
         """
-        device = question_with_context["input_ids"].device
-
         outputs = self._qa_model(**question_with_context)
         span_start_logits = outputs["start_logits"]
         span_end_logits = outputs["end_logits"]
 
         with torch.no_grad():
-            possible_answer_mask = torch.zeros_like(
-                question_with_context["input_ids"], dtype=torch.bool,
+            possible_answer_mask = get_possible_answer_mask(
+                question_with_context["input_ids"],
+                [yes_no_span] if self.force_yes_no else [context_span, yes_no_span],
             )
-            if not self.force_yes_no:
-                for i, (start, end) in enumerate(context_span):
-                    if start != -1 and end != -1:
-                        possible_answer_mask[i, start : end + 1] = True
-
-            if yes_no_span is not None:
-                for i, (start, end) in enumerate(yes_no_span):
-                    if start != -1 and end != -1:
-                        possible_answer_mask[i, start : end + 1] = True
-
-            for i in range(len(possible_answer_mask)):
-                assert any(possible_answer_mask[i])
+            assert bool(possible_answer_mask.any(dim=1).all())
 
             # Replace the masked values with a very negative constant.
             context_masked_span_start_logits = replace_masked_values_with_big_negative_number(
@@ -176,10 +182,14 @@ class TransformerQA(Model):
             output_dict = {
                 "best_span": best_spans,
                 "best_span_scores": best_span_scores,
-                "yes_scores": span_start_logits[:, yes_no_span[:, 0]]
-                + span_end_logits[:, yes_no_span[:, 0]],
-                "no_scores": span_start_logits[:, yes_no_span[:, 1]]
-                + span_end_logits[:, yes_no_span[:, 1]],
+                "yes_scores": (
+                    span_start_logits.gather(1, yes_no_span[:, 0:1])
+                    + span_end_logits.gather(1, yes_no_span[:, 0:1])
+                ).squeeze(1),
+                "no_scores": (
+                    span_start_logits.gather(1, yes_no_span[:, 1:2])
+                    + span_end_logits.gather(1, yes_no_span[:, 1:2])
+                ).squeeze(1),
             }
             if self._enable_no_answer:
                 no_answer_scores = span_start_logits[:, 0] + span_end_logits[:, 0]
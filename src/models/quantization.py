@@ -0,0 +1,37 @@
+import logging
+
+import torch
+
+from allennlp.models import Model
+from allennlp.models.archival import Archive, load_archive
+
+logger = logging.getLogger(__name__)
+
+# the pretrained transformers of the transformer_qa_v2 and q_gen models
+QUANTIZED_SUBMODULES = ["_qa_model", "_seq2seq"]
+
+
+def quantize_model(model: Model) -> Model:
+    """
+    Applies int8 dynamic quantization to the Linear layers of the pretrained transformer of the model
+    (in place), for inference on CPU. The weights are quantized once, and the activations on the fly.
+    """
+    quantized = False
+    for name in QUANTIZED_SUBMODULES:
+        submodule = getattr(model, name, None)
+        if submodule is not None:
+            setattr(model, name, torch.quantization.quantize_dynamic(submodule, {torch.nn.Linear}, dtype=torch.qint8))
+            quantized = True
+    if not quantized:
+        raise ValueError(f"{type(model).__name__} has none of the quantized submodules {QUANTIZED_SUBMODULES}")
+    return model
+
+
+def load_quantized_archive(archive_file: str, cuda_device: int = -1, **kwargs) -> Archive:
+    """Same as allennlp's load_archive, with a dynamically quantized model (which runs only on CPU)."""
+    if cuda_device >= 0:
+        raise ValueError("Dynamic quantization is supported only on CPU (cuda_device=-1)")
+    archive = load_archive(archive_file, cuda_device=cuda_device, **kwargs)
+    quantize_model(archive.model)
+    logger.info(f"Applied int8 dynamic quantization to the model of {archive_file}")
+    return archive
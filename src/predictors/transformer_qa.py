@@ -1,5 +1,6 @@
 from typing import List, Dict, Any
 
+import numpy as np
 from allennlp.models import Model
 from overrides import overrides
 
@@ -7,6 +8,9 @@ from allennlp.common.util import JsonDict, sanitize
 from allennlp.data import Instance, DatasetReader
 from allennlp.predictors.predictor import Predictor
 
+# the maximal number of (padded) tokens in a batch of the model, e.g. 8 instances of 512 tokens or 32 of 128 tokens
+DEFAULT_MAX_BATCH_TOKENS = 4096
+
 
 @Predictor.register("transformer_qa_v2")
 class TransformerQAPredictor(Predictor):
@@ -15,9 +19,13 @@ class TransformerQAPredictor(Predictor):
     other model that takes a question and passage as input.
     """
 
-    def __init__(self, model: Model, dataset_reader: DatasetReader) -> None:
+    def __init__(
+        self, model: Model, dataset_reader: DatasetReader, max_batch_tokens: int = DEFAULT_MAX_BATCH_TOKENS
+    ) -> None:
         super(TransformerQAPredictor, self).__init__(model, dataset_reader)
         self._next_qid = 1
+        # instances are run in batches of similar lengths, with up to max_batch_tokens tokens (None for a single batch)
+        self.max_batch_tokens = max_batch_tokens
 
     def predict(self, question: str, passage: str) -> JsonDict:
         """
@@ -93,51 +101,86 @@ class TransformerQAPredictor(Predictor):
         force_yes_no=False,
     ) -> List[JsonDict]:
         self._model.force_yes_no = force_yes_no  # Ugly hack
-        outputs = self._model.forward_on_instances(instances)
+        outputs = self._forward_on_length_buckets(instances)
+        if len(outputs) == 0:
+            return []
 
-        # group outputs with the same question id
-        qid_to_output: Dict[str, Dict[str, Any]] = {}
-        qid_to_score_null = {}
-        qid_to_null_output = {}
+        # group outputs with the same question id (one per passage window), in the order of their first output
+        qid_to_group: Dict[str, int] = {}
+        groups = []
         for instance, output in zip(instances, outputs):
             qid = instance["metadata"]["id"]
 
             output["answers"] = instance["metadata"]["answers"]
             output["token_answer_span"] = instance["metadata"]["token_answer_span"]
 
-            if group_same_id:
-                output["id"] = qid
-                if qid in qid_to_output:
-                    old_output = qid_to_output[qid]
-
-                    if "no_answer_scores" in old_output:
-                        if output["no_answer_scores"] < qid_to_score_null[qid]:
-                            qid_to_score_null[qid] = output["no_answer_scores"]
-                            qid_to_null_output[qid] = output
-
-                    if old_output["best_span_scores"] < output["best_span_scores"]:
-                        qid_to_output[qid] = output
-                else:
-                    qid_to_output[qid] = output
-                    if "no_answer_scores" in output:
-                        qid_to_score_null[qid] = output["no_answer_scores"]
-                        qid_to_null_output[qid] = output
-            else:
+            if not group_same_id:
                 window_index = instance["metadata"]["window_index"]
-                full_id = f"{qid}_{str(window_index)}" if window_index is not None else qid
-                output["id"] = full_id
-                qid_to_output[full_id] = output
-                if "no_answer_scores" in output:
-                    qid_to_score_null[qid] = output["no_answer_scores"]
-                    qid_to_null_output[qid] = output
-
-        for qid, score_null in qid_to_score_null.items():
-            qid_to_output[qid]["no_answer_scores"] = score_null
-            if allow_null:
-                if score_null > qid_to_output[qid]["best_span_scores"]:
-                    qid_to_output[qid] = qid_to_null_output[qid]
-                    qid_to_output[qid]["best_span_str"] = ""
-                    qid_to_output[qid]["best_span"] = (-1, -1)
-                    qid_to_output[qid]["best_span_scores"] = score_null
-
-        return [sanitize(o) for o in qid_to_output.values()]
+                qid = f"{qid}_{str(window_index)}" if window_index is not None else qid
+            output["id"] = qid
+            groups.append(qid_to_group.setdefault(qid, len(qid_to_group)))
+        groups = np.array(groups)
+
+        best_span_scores = np.array([output["best_span_scores"] for output in outputs], dtype=np.float64)
+        best_indices = get_best_index_per_group(groups, best_span_scores)
+        group_outputs = [outputs[i] for i in best_indices]
+
+        if "no_answer_scores" in outputs[0]:
+            no_answer_scores = np.array([output["no_answer_scores"] for output in outputs], dtype=np.float64)
+            null_indices = get_best_index_per_group(groups, -no_answer_scores)
+            for group, null_i in enumerate(null_indices):
+                null_output = outputs[null_i]
+                score_null = null_output["no_answer_scores"]
+                group_outputs[group]["no_answer_scores"] = score_null
+                if allow_null:
+                    if score_null > group_outputs[group]["best_span_scores"]:
+                        null_output["best_span_str"] = ""
+                        null_output["best_span"] = (-1, -1)
+                        null_output["best_span_scores"] = score_null
+                        group_outputs[group] = null_output
+
+        return [sanitize(o) for o in group_outputs]
+
+    def _forward_on_length_buckets(self, instances: List[Instance]) -> List[Dict[str, Any]]:
+        """Runs the model on the instances in batches of similar lengths (so short instances are not padded to the
+        length of long ones), and returns the outputs in the order of the instances."""
+        if self.max_batch_tokens is None:
+            return self._model.forward_on_instances(instances)
+        lengths = [len(instance["question_with_context"]) for instance in instances]
+        outputs: List[Dict[str, Any]] = [None] * len(instances)
+        for bucket in get_length_buckets(lengths, self.max_batch_tokens):
+            bucket_outputs = self._model.forward_on_instances([instances[i] for i in bucket])
+            for i, output in zip(bucket, bucket_outputs):
+                outputs[i] = output
+        return outputs
+
+
+def get_length_buckets(lengths: List[int], max_batch_tokens: int) -> List[List[int]]:
+    """
+    Splits the indices of the lengths into batches, sorted by length, such that every batch padded to its
+    longest length has up to max_batch_tokens tokens (or a single index, if it is longer than that).
+    """
+    buckets = []
+    bucket: List[int] = []
+    for i in np.argsort(lengths, kind="stable").tolist():
+        # the lengths are sorted, so the current length is the longest in the bucket
+        if bucket and (len(bucket) + 1) * lengths[i] > max_batch_tokens:
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+    if bucket:
+        buckets.append(bucket)
+    return buckets
+
+
+def get_best_index_per_group(groups: np.ndarray, scores: np.ndarray) -> np.ndarray:
+    """
+    Returns the index of the highest score of every group (the first one, on ties), ordered by group.
+    `groups` are the group numbers (0 to the number of groups - 1) of the scores.
+    """
+    # a stable sort by group, and by descending score within every group
+    order = np.lexsort((-scores, groups))
+    sorted_groups = groups[order]
+    is_group_start = np.ones(len(order), dtype=bool)
+    is_group_start[1:] = sorted_groups[1:] != sorted_groups[:-1]
+    return order[is_group_start]
@@ -1,10 +1,10 @@
 
 import argparse
 import json
+import numpy as np
 import pandas as pd
 
-from qdmr_transforms.qdmr_example import \
-    get_orig_example_id, get_transform_base_info, get_transform_from_example_id
+from qdmr_transforms.qdmr_example import parse_transformed_ids
 from src.data.dataset_readers.drop import DropReader
 
 reader = DropReader()
@@ -66,35 +66,41 @@ def check_prediction_constraint(prediction, constraint, orig_answer):
     return -1
 
 
-def are_gen_orig_correct(row, f1_threshold=-1):
+def are_gen_orig_correct(df, f1_threshold=-1):
     if f1_threshold > 0:
-        return int(row["f1_orig"] > f1_threshold and row["f1_gen"] > f1_threshold)
+        return ((df["f1_orig"] > f1_threshold) & (df["f1_gen"] > f1_threshold)).astype(int)
     else:
-        return int(row["em_orig"] == 1 and row["em_gen"] == 1)
+        return ((df["em_orig"] == 1) & (df["em_gen"] == 1)).astype(int)
 
 
-def are_gen_orig_satisfied(row, f1_threshold=-1):
+def are_gen_orig_satisfied(df, f1_threshold=-1):
     if f1_threshold > 0:
-        return int(row["f1_orig"] > f1_threshold and row["score_gen"] == 1)
+        return ((df["f1_orig"] > f1_threshold) & (df["score_gen"] == 1)).astype(int)
     else:
-        return int(row["em_orig"] == 1 and row["score_gen"] == 1)
+        return ((df["em_orig"] == 1) & (df["score_gen"] == 1)).astype(int)
 
 
-def are_gen_orig_correct_satisfied(row, f1_threshold=-1):
+def are_gen_orig_correct_satisfied(df, f1_threshold=-1):
+    # answer examples have no constraint score, constraint examples have one
+    is_answer_example = df["score_gen"].isna()
     if f1_threshold > 0:
-        # this is an answer example
-        if pd.isna(row["score_gen"]):
-            return int(row["f1_orig"] > f1_threshold and row["f1_gen"] > f1_threshold)
-        # this is a constraint example
-        else:
-            return int(row["f1"] > f1_threshold and row["score_gen"] == 1)
+        answer_correct = (df["f1_orig"] > f1_threshold) & (df["f1_gen"] > f1_threshold)
+        constraint_satisfied = (df["f1"] > f1_threshold) & (df["score_gen"] == 1)
     else:
-        # this is an answer example
-        if pd.isna(row["score_gen"]):
-            return int(row["em_orig"] == 1 and row["em_gen"] == 1)
-        # this is a constraint example
-        else:
-            return int(row["em"] == 1 and row["score_gen"] == 1)
+        answer_correct = (df["em_orig"] == 1) & (df["em_gen"] == 1)
+        constraint_satisfied = (df["em"] == 1) & (df["score_gen"] == 1)
+    return pd.Series(np.where(is_answer_example, answer_correct, constraint_satisfied),
+                     index=df.index).astype(int)
+
+
+def add_transform_id_columns(df, qid_field="qid"):
+    """Parse the transformed example ids in one pass over the qid column,
+    and add their base id, transformation base and transformation info columns."""
+    parsed_ids = parse_transformed_ids(df[qid_field], clean=True)
+    df["base_id"] = parsed_ids["orig_id"]
+    df["transform_base"] = parsed_ids["transform_base"]
+    df["transform_info"] = parsed_ids["transform_info"]
+    return df
 
 
 def load_prediction_files(gen_preds_path, orig_preds_path, gen_const_preds_path, orig_const_preds_path):
@@ -142,12 +148,8 @@ def constraint_evaluation(constraints, gen_const_preds_raw):
         if score == -1:
             print(f"[-] issue with evaluation of example: {qid}")
         else:
-            transform_base, transform_info = get_transform_base_info(get_transform_from_example_id(qid))
             gen_const_preds.append({
                 "qid": qid,
-                "base_id": get_orig_example_id(qid, clean=True),
-                "transform_base": transform_base,
-                "transform_info": transform_info,
                 "prediction": gen_const_preds_raw[qid],
                 "constraint": constraint,
                 "score_gen": float(score)
@@ -164,27 +166,14 @@ def build_gen_orig_ans_preds_df(gen_ans_preds, orig_ans_preds):
     else:
         raise NotImplementedError
 
-    for gen_pred in gen_ans_preds:
-        gen_pred["base_id"] = get_orig_example_id(gen_pred[qid_field], clean=True)
-        gen_pred["transform_base"], gen_pred["transform_info"] = get_transform_base_info(
-            get_transform_from_example_id(gen_pred[qid_field])
-        )
-        if qid_field == "query_id":
-            gen_pred["qid"] = gen_pred["query_id"]
-    for orig_pred in orig_ans_preds:
-        orig_pred["base_id"] = orig_pred[qid_field]
-
-    df_gen = pd.DataFrame.from_records(gen_ans_preds)
+    df_gen = add_transform_id_columns(pd.DataFrame.from_records(gen_ans_preds), qid_field)
+    if qid_field == "query_id":
+        df_gen["qid"] = df_gen["query_id"]
     df_orig = pd.DataFrame.from_records(orig_ans_preds)
+    df_orig["base_id"] = df_orig[qid_field]
     df = pd.merge(df_gen, df_orig, on="base_id", suffixes=("_gen", "_orig"))
-    df["gen_orig_correct_em"] = df.apply(
-        lambda row: are_gen_orig_correct(row),
-        axis=1
-    )
-    df["gen_orig_correct_f1_th0.8"] = df.apply(
-        lambda row: are_gen_orig_correct(row, f1_threshold=0.8),
-        axis=1
-    )
+    df["gen_orig_correct_em"] = are_gen_orig_correct(df)
+    df["gen_orig_correct_f1_th0.8"] = are_gen_orig_correct(df, f1_threshold=0.8)
 
     return df_gen, df_orig, df
 
@@ -197,22 +186,14 @@ def build_gen_orig_const_preds_df(gen_const_preds, orig_const_preds):
     else:
         raise NotImplementedError
 
-    for orig_pred in orig_const_preds:
-        orig_pred["base_id"] = orig_pred[qid_field]
-        orig_pred["f1_orig"] = orig_pred["f1"]
-        orig_pred["em_orig"] = orig_pred["em"]
-
-    df_gen_const = pd.DataFrame.from_records(gen_const_preds)
+    df_gen_const = add_transform_id_columns(pd.DataFrame.from_records(gen_const_preds))
     df_orig_const = pd.DataFrame.from_records(orig_const_preds)
+    df_orig_const["base_id"] = df_orig_const[qid_field]
+    df_orig_const["f1_orig"] = df_orig_const["f1"]
+    df_orig_const["em_orig"] = df_orig_const["em"]
     df_const = pd.merge(df_gen_const, df_orig_const, on="base_id", suffixes=("_gen", "_orig"))
-    df_const["gen_orig_correct_em"] = df_const.apply(
-        lambda row: are_gen_orig_satisfied(row),
-        axis=1
-    )
-    df_const["gen_orig_correct_f1_th0.8"] = df_const.apply(
-        lambda row: are_gen_orig_satisfied(row, f1_threshold=0.8),
-        axis=1
-    )
+    df_const["gen_orig_correct_em"] = are_gen_orig_satisfied(df_const)
+    df_const["gen_orig_correct_f1_th0.8"] = are_gen_orig_satisfied(df_const, f1_threshold=0.8)
 
     return df_gen_const, df_orig_const, df_const
 
@@ -229,14 +210,8 @@ def merge_ans_const_dfs(df_ans, df_const):
     print(f"merged {len(df_ans)} answer examples with {len(df_const_)} constraint examples to overall "
           f"{len(df_merged)} examples. ( len(df_ans) + len(df_const_) = {len(df_ans)+len(df_const_)} )")
 
-    df_merged["gen_orig_correct_em"] = df_merged.apply(
-        lambda row: are_gen_orig_correct_satisfied(row),
-        axis=1
-    )
-    df_merged["gen_orig_correct_f1_th0.8"] = df_merged.apply(
-        lambda row: are_gen_orig_correct_satisfied(row, f1_threshold=0.8),
-        axis=1
-    )
+    df_merged["gen_orig_correct_em"] = are_gen_orig_correct_satisfied(df_merged)
+    df_merged["gen_orig_correct_f1_th0.8"] = are_gen_orig_correct_satisfied(df_merged, f1_threshold=0.8)
 
     return df_merged
 
@@ -367,8 +342,8 @@ def main():
                     df_gen_const, df_orig_const, df_const,
                     df_merged]:
             if df_ is not None and "transform_base" in df_.columns:
-                df_["transform_base"] = df_["transform_base"].apply(
-                    lambda x: "prune_step" if x.startswith("prune") else x
+                df_["transform_base"] = df_["transform_base"].mask(
+                    df_["transform_base"].str.startswith("prune"), "prune_step"
                 )
 
     if df_gen_ans is not None and not args.only_merged:
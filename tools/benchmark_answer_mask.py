@@ -0,0 +1,77 @@
+import argparse
+import time
+
+import torch
+
+from src.models.qa.transformer_qa import get_possible_answer_mask
+
+
+def get_possible_answer_mask_loop(input_ids, context_span, yes_no_span):
+    """The mask as TransformerQA.forward built it before, with a slice assignment and a check per row."""
+    possible_answer_mask = torch.zeros_like(input_ids, dtype=torch.bool)
+    for i, (start, end) in enumerate(context_span):
+        if start != -1 and end != -1:
+            possible_answer_mask[i, start: end + 1] = True
+    for i, (start, end) in enumerate(yes_no_span):
+        if start != -1 and end != -1:
+            possible_answer_mask[i, start: end + 1] = True
+    for i in range(len(possible_answer_mask)):
+        assert any(possible_answer_mask[i])
+    return possible_answer_mask
+
+
+def get_possible_answer_mask_vectorized(input_ids, context_span, yes_no_span):
+    possible_answer_mask = get_possible_answer_mask(input_ids, [context_span, yes_no_span])
+    assert bool(possible_answer_mask.any(dim=1).all())
+    return possible_answer_mask
+
+
+def get_batch(batch_size, sequence_length, device, generator):
+    """Random inputs shaped as the model's: "yes no" at the start, then the question and the context."""
+    input_ids = torch.randint(5, 1000, (batch_size, sequence_length), generator=generator)
+    context_start = torch.randint(8, 40, (batch_size,), generator=generator)
+    context_end = torch.randint(sequence_length // 2, sequence_length - 1, (batch_size,), generator=generator)
+    context_span = torch.stack([context_start, context_end], dim=1)
+    # some instances have no context span
+    context_span[torch.rand(batch_size, generator=generator) < 0.1] = -1
+    yes_no_span = torch.tensor([[1, 2]] * batch_size)
+    return input_ids.to(device), context_span.to(device), yes_no_span.to(device)
+
+
+def time_function(function, inputs, device, repeats):
+    times = []
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        start = time.perf_counter()
+        function(*inputs)
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main(args):
+    device = torch.device(args.device)
+    generator = torch.Generator().manual_seed(args.seed)
+    print(f"sequence length {args.sequence_length}, {args.device}, median of {args.repeats} runs")
+    print(f"{'batch size':>10} {'loop (ms)':>10} {'vectorized (ms)':>16} {'speedup':>8}  same mask")
+    for batch_size in args.batch_sizes:
+        inputs = get_batch(batch_size, args.sequence_length, device, generator)
+        same_mask = torch.equal(get_possible_answer_mask_loop(*inputs), get_possible_answer_mask_vectorized(*inputs))
+        loop_time = time_function(get_possible_answer_mask_loop, inputs, device, args.repeats)
+        vectorized_time = time_function(get_possible_answer_mask_vectorized, inputs, device, args.repeats)
+        print(f"{batch_size:>10} {loop_time * 1000:>10.3f} {vectorized_time * 1000:>16.3f} "
+              f"{loop_time / vectorized_time:>7.1f}x  {same_mask}")
+
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--batch_sizes", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32, 64, 128])
+    parse.add_argument("--sequence_length", type=int, default=512)
+    parse.add_argument("--device", type=str, default="cpu")
+    parse.add_argument("--repeats", type=int, default=20)
+    parse.add_argument("--seed", type=int, default=42)
+    args = parse.parse_args()
+
+    main(args)
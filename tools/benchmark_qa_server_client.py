@@ -0,0 +1,137 @@
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from src.models.iterative.qa_server_client import QAServerClient
+
+
+class StandInQAHandler(BaseHTTPRequestHandler):
+    """Answers `/predict` requests like the QA model server, with the first passage word that appears
+    in the question (or the first passage word), after `latency` seconds. A `failure_rate` fraction of the
+    requests get a 503 response."""
+
+    protocol_version = "HTTP/1.1"  # keep-alive
+    disable_nagle_algorithm = True  # otherwise, keep-alive responses wait for delayed acks
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.path != "/predict":
+            self.send_error(404)
+            return
+        payload = json.loads(body)
+        time.sleep(self.server.latency)
+        if self.server.random.random() < self.server.failure_rate:
+            self._send(503, b"")
+            return
+        question_words = set(payload["question"].lower().split())
+        passage_words = payload["passage"].split()
+        value = next((word for word in passage_words if word.lower() in question_words), passage_words[0])
+        self._send(200, json.dumps({"answer": {"value": value}}).encode("utf-8"))
+
+    def _send(self, status, data):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stand_in_server(port=0, latency=0.0, failure_rate=0.0, seed=42):
+    """Start a stand-in QA server in a background thread, and return it (its port is server.server_port)."""
+    server = ThreadingHTTPServer(("localhost", port), StandInQAHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.failure_rate = failure_rate
+    server.random = random.Random(seed)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_sequential_answers(port, questions_paragraphs):
+    """The answers as get_answer in run_model.py gets them, with a blocking request per paragraph."""
+    answers = []
+    for question, paragraphs in questions_paragraphs:
+        answer = None
+        for paragraph in paragraphs:
+            response_raw = requests.post(
+                f'http://localhost:{port}/predict',
+                data=json.dumps({"passage": paragraph, "question": question + " yes no"}),
+                headers={'content-type': 'application/json'}
+            )
+            answer = response_raw.json()["answer"]["value"]
+        answers.append(answer)
+    return answers
+
+
+def get_questions_paragraphs(num_questions, seed):
+    rng = random.Random(seed)
+    words = ["touchdowns", "yards", "Rice", "Bears", "quarter", "goals", "players", "passes", "2005", "river"]
+    passages = [" ".join(rng.choice(words) for _ in range(200)) for _ in range(20)]
+    return [
+        (f"what are the {rng.choice(words)} of {rng.choice(words)}?", [rng.choice(passages)])
+        for _ in range(num_questions)
+    ]
+
+
+def main(args):
+    if args.serve:
+        server = start_stand_in_server(args.port, args.latency, args.failure_rate, args.seed)
+        print(f"serving a stand-in QA model at http://localhost:{server.server_port}/predict")
+        threading.Event().wait()
+
+    questions_paragraphs = get_questions_paragraphs(args.num_questions, args.seed)
+
+    server = start_stand_in_server(args.port, args.latency, failure_rate=0.0, seed=args.seed)
+    start = time.perf_counter()
+    sequential_answers = get_sequential_answers(server.server_port, questions_paragraphs)
+    sequential_time = time.perf_counter() - start
+    print(f"sequential: {len(questions_paragraphs) / sequential_time:.1f} questions/sec")
+
+    for concurrency in args.concurrency:
+        client = QAServerClient(server.server_port, concurrency=concurrency, backoff=0.01)
+        start = time.perf_counter()
+        answers = client.get_answers(questions_paragraphs)
+        pooled_time = time.perf_counter() - start
+        client.close()
+        print(f"pooled (concurrency {concurrency}): {len(questions_paragraphs) / pooled_time:.1f} questions/sec "
+              f"({sequential_time / pooled_time:.1f}x), same answers: {answers == sequential_answers}")
+    server.shutdown()
+    server.server_close()
+
+    if args.failure_rate > 0:
+        server = start_stand_in_server(args.port, args.latency, args.failure_rate, args.seed)
+        client = QAServerClient(server.server_port, concurrency=max(args.concurrency), backoff=0.01)
+        answers = client.get_answers(questions_paragraphs)
+        client.close()
+        server.shutdown()
+        server.server_close()
+        num_errors = sum(isinstance(answer, Exception) for answer in answers)
+        num_same = sum(answer == expected for answer, expected in zip(answers, sequential_answers))
+        print(f"with {args.failure_rate:.0%} failing requests: {client.stats()}, "
+              f"{num_same} same answers, {num_errors} errors")
+
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--num_questions", type=int, default=500)
+    parse.add_argument("--latency", type=float, default=0.01,
+                       help="seconds the stand-in server waits before answering a request")
+    parse.add_argument("--failure_rate", type=float, default=0.1,
+                       help="fraction of the requests the stand-in server fails (to exercise the retries)")
+    parse.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parse.add_argument("--serve", action="store_true",
+                       help="only run the stand-in server (e.g. for run_model.py --qa-model-server-port)")
+    parse.add_argument("--port", type=int, default=0,
+                       help="port of the stand-in server (by default, a free port)")
+    parse.add_argument("--seed", type=int, default=42)
+    args = parse.parse_args()
+
+    main(args)
@@ -0,0 +1,365 @@
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+
+# in the working directory, not in the source tree
+DEFAULT_BASELINE_PATH = "qdmr_benchmark_baseline.json"
+DEFAULT_THRESHOLD = 0.2
+# every timed sample runs passes until it reaches this duration, so it is not dominated by timer noise
+DEFAULT_MIN_SAMPLE_SECONDS = 0.2
+# peak memory differences below this are noise (e.g. of the allocator), whatever their ratio is
+DEFAULT_MEMORY_FLOOR_KB = 64
+# the version of the measurements, which is part of the baseline configuration
+BENCHMARK_VERSION = 2
+
+NOUNS = ["touchdowns", "field goals", "players", "yards", "passes", "rivers", "cities", "films", "papers",
+         "authors", "flights", "objects", "countries", "teams", "years", "quarters", "games", "albums"]
+ATTRIBUTES = ["length", "population", "number", "year", "size", "color", "name", "height", "capacity"]
+CONDITIONS = ["in the first quarter", "from boston", "that are green", "before 2005", "of the Bears",
+              "that Rice scored", "in the second half", "after 8am", "that are metallic"]
+VALUES = ["two", "17", "60", "one", "300 dollars", "2005"]
+
+
+def get_args():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--qdmrs_path", type=str, default=None,
+                       help="path to a csv file with QDMRs in the Break format, to sample QDMRs from "
+                            "(in addition to the synthetic QDMRs)")
+    parse.add_argument("--num_synthetic", type=int, default=400,
+                       help="number of synthetic QDMRs (with 1-20 steps)")
+    parse.add_argument("--num_sampled", type=int, default=400,
+                       help="number of QDMRs (with 1-20 steps) to sample from qdmrs_path")
+    parse.add_argument("--repeats", type=int, default=7,
+                       help="number of timed samples per benchmark (the median sample is reported)")
+    parse.add_argument("--min_sample_seconds", type=float, default=DEFAULT_MIN_SAMPLE_SECONDS,
+                       help="minimal duration of a timed sample, which runs as many passes as needed to reach it")
+    parse.add_argument("--baseline_path", type=str, default=DEFAULT_BASELINE_PATH,
+                       help="path to a json file with the baseline results "
+                            "(by default, qdmr_benchmark_baseline.json in the working directory)")
+    parse.add_argument("--save_baseline", action="store_true",
+                       help="store the results as the new baseline, instead of comparing against it")
+    parse.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                       help="maximal allowed relative regression in speed (relative to a reference workload) "
+                            "and peak memory")
+    parse.add_argument("--memory_floor_kb", type=float, default=DEFAULT_MEMORY_FLOOR_KB,
+                       help="peak memory increases below this number of KB are not regressions")
+    parse.add_argument("--real_spacy", action="store_true",
+                       help="use the installed spaCy model instead of a whitespace tokenizer stub")
+    parse.add_argument("--seed", type=int, default=42)
+    return parse.parse_args()
+
+
+def install_spacy_stub():
+    """Replace spaCy with a whitespace tokenizer, so the benchmarks run offline and do not
+    depend on the installed spaCy model. Provides only what question_transformation.py uses."""
+
+    class Token(object):
+        def __init__(self, text, i):
+            self.text = text
+            self.i = i
+            self.lemma_ = "do" if text.lower() in ["do", "did", "does"] else text.lower()
+
+    class Doc(list):
+        def __getitem__(self, key):
+            item = list.__getitem__(self, key)
+            return Doc(item) if isinstance(key, slice) else item
+
+        @property
+        def text(self):
+            return " ".join(token.text for token in self)
+
+    def nlp(text):
+        return Doc(Token(text, i) for i, text in enumerate(text.replace("?", " ?").split()))
+
+    def load(name, disable=None):
+        nlp.pipe = lambda texts, batch_size=None: (nlp(text) for text in texts)
+        return nlp
+
+    spacy = types.ModuleType("spacy")
+    spacy.load = load
+    sys.modules["spacy"] = spacy
+
+
+def synthetic_step(rng, i):
+    """Return a random QDMR step (of a random operator) whose references precede step i (1-based)"""
+    if i == 1:
+        return f"return {rng.choice(NOUNS)}"
+    ref = rng.randint(1, i - 1)
+    other = rng.randint(1, i - 1)
+    templates = [
+        f"return {rng.choice(ATTRIBUTES)} of #{ref}",
+        f"return #{ref} {rng.choice(CONDITIONS)}",
+        f"return number of #{ref}",
+        f"return the highest of #{ref}",
+        f"return if #{ref} is {rng.choice(VALUES)}",
+        f"return {rng.choice(NOUNS)}",
+    ]
+    if ref != other:
+        templates += [
+            f"return #{ref} where #{other} is more than {rng.choice(VALUES)}",
+            f"return #{ref} where #{other} is highest",
+            f"return the difference of #{ref} and #{other}",
+            f"return #{ref} , #{other}",
+            f"return number of #{ref} for each #{other}",
+            f"return #{ref} besides #{other}",
+            f"return #{ref} sorted by #{other}",
+            f"return which is highest of #{ref} , #{other}",
+            f"return if both #{ref} and #{other} are true",
+        ]
+    return rng.choice(templates)
+
+
+def synthetic_qdmrs(num_qdmrs, rng):
+    records = []
+    for i in range(num_qdmrs):
+        num_steps = 1 + i % 20
+        steps = [synthetic_step(rng, j) for j in range(1, num_steps)]
+        # most questions end with an aggregation, as in DROP, to exercise the append-boolean transformations
+        steps += [f"return number of #{num_steps - 1}" if num_steps > 1 else synthetic_step(rng, 1)]
+        records.append({
+            "question_id": f"SYN_dev_{i}",
+            "question_text": f"How many {rng.choice(NOUNS)} did the {rng.choice(NOUNS)} have?",
+            "decomposition": " ;".join(steps)
+        })
+    return records
+
+
+def sampled_qdmrs(qdmrs_path, num_qdmrs, rng):
+    from qdmr_transforms.utils import parse_decomposition
+
+    with open(qdmrs_path, "r", encoding="utf-8") as fd:
+        records = [record for record in csv.DictReader(fd)
+                   if 1 <= len(parse_decomposition(record["decomposition"])) <= 20]
+    return rng.sample(records, min(num_qdmrs, len(records)))
+
+
+def write_qdmrs_csv(records, csv_path):
+    with open(csv_path, "w", newline='', encoding="utf-8") as fd:
+        writer = csv.DictWriter(fd, fieldnames=["question_id", "question_text", "decomposition"],
+                                extrasaction='ignore', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def reference_pass(records):
+    """A fixed pure-Python workload, independent of the benchmarked code. It is timed next to every sample,
+    so the speed changes of the machine (e.g. of a shared CPU) are normalized out of the comparison."""
+    for record in records:
+        " ".join(sorted(record["decomposition"].replace("#", " ").split(" ;")))
+    json.loads(json.dumps(records))
+
+
+def time_passes(setup, run, min_seconds):
+    """Return the QDMRs/sec of running run(setup()) in passes until they take min_seconds.
+    setup() returns the inputs of a pass and their number of QDMRs, and is not timed."""
+    from qdmr_transforms.qdmr_identifier import clear_parse_cache
+
+    elapsed = 0
+    num_timed_qdmrs = 0
+    while elapsed < min_seconds or num_timed_qdmrs == 0:
+        clear_parse_cache()
+        inputs, num_qdmrs = setup()
+        start = time.perf_counter()
+        run(inputs)
+        elapsed += time.perf_counter() - start
+        num_timed_qdmrs += num_qdmrs
+    return num_timed_qdmrs / max(elapsed, 1e-9)
+
+
+def run_benchmark(name, setup, run, repeats, min_sample_seconds, reference_setup):
+    """Time run(setup()) over the benchmark QDMRs, and measure its peak memory in a separate pass.
+    Every one of the repeats samples runs passes until they take min_sample_seconds, between two timings of
+    the reference pass (over reference_setup()). The median QDMRs/sec of the samples is reported, together with
+    its ratio to the median speed of the reference pass."""
+    from qdmr_transforms.qdmr_identifier import clear_parse_cache
+
+    samples = []
+    reference_samples = []
+    for _ in range(repeats):
+        reference_samples.append(time_passes(reference_setup, reference_pass, min_sample_seconds / 4))
+        samples.append(time_passes(setup, run, min_sample_seconds))
+        reference_samples.append(time_passes(reference_setup, reference_pass, min_sample_seconds / 4))
+    qdmrs_per_sec = sorted(samples)[len(samples) // 2]
+    reference_per_sec = sorted(reference_samples)[len(reference_samples) // 2]
+
+    clear_parse_cache()
+    inputs, num_qdmrs = setup()
+    tracemalloc.start()
+    run(inputs)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    result = {
+        "qdmrs_per_sec": round(qdmrs_per_sec, 2),
+        "relative_speed": round(qdmrs_per_sec / reference_per_sec, 4),
+        "peak_memory_kb": round(peak_memory / 1024, 2)
+    }
+    print(f"{name:<40} {result['qdmrs_per_sec']:>12} QDMRs/sec {result['relative_speed']:>10} relative "
+          f"{result['peak_memory_kb']:>12} KB peak")
+    return result
+
+
+def run_benchmarks(records, qdmrs_csv_path, repeats, min_sample_seconds):
+    from qdmr_transforms.qdmr_editor import QDMREditor
+    from qdmr_transforms.qdmr_example import QDMRExample
+    from qdmr_transforms.qdmr_identifier import StepIdentifier
+    from qdmr_transforms.qdmr_transformations import OpReplaceTransform, PruneLastTransform, \
+        PruneStepTransform, ChangeLastStepTransform, AppendBooleanTransform
+    from qdmr_transforms.question_transformation import clear_question_cache
+    from qdmr_transforms.transformation_filters import TransformFilter, TRANSFORM_FILTERS
+    from qdmr_transforms.utils import parse_decomposition
+
+    qdmrs = [record["decomposition"] for record in records]
+    # the reference pass is timed over the records, as a single unit
+    reference_setup = lambda: (records, 1)
+    numeric_qa_data = {record["question_id"]: 5 for record in records}
+    transform_classes = {
+        "OpReplaceTransform": OpReplaceTransform,
+        "PruneLastTransform": PruneLastTransform,
+        "PruneStepTransform": PruneStepTransform,
+        "ChangeLastStepTransform": ChangeLastStepTransform,
+        "AppendBooleanTransform": lambda example: AppendBooleanTransform(example,
+                                                                         numeric_qa_data=numeric_qa_data),
+    }
+
+    def examples():
+        return [QDMRExample(record["question_id"], record["question_text"], record["decomposition"])
+                for record in records]
+
+    def transformed_examples():
+        transformed = []
+        for example in examples():
+            for transform_class in transform_classes.values():
+                transformed += transform_class(example).transformations()
+        return transformed
+
+    def qdmr_edits(qdmr):
+        qdmr_editor = QDMREditor(qdmr)
+        num_steps = len(qdmr_editor.qdmr_steps)
+        qdmr_editor.add_new_step(num_steps + 1, f"return if #{num_steps} is more than two")
+        qdmr_editor.replace_step(1, qdmr_editor.get_step(1))
+        qdmr_editor.remove_step(num_steps + 1)
+        return qdmr_editor.get_qdmr_text()
+
+    step_identifier = StepIdentifier()
+    transform_filter = TransformFilter(TRANSFORM_FILTERS, qdmr_data=qdmrs_csv_path, operator_dist_threshold=0.15)
+
+    def identify_steps(steps_lists):
+        for steps in steps_lists:
+            for step in steps:
+                try:
+                    step_identifier.identify(step)
+                except Exception:
+                    pass
+
+    def apply_transform(transform_class):
+        def run(qdmr_examples):
+            clear_question_cache()
+            for example in qdmr_examples:
+                # the transformed QDMRs are built lazily, so they are built here to measure their cost
+                for transformed in transform_class(example).transformations():
+                    transformed.qdmr
+        return run
+
+    def benchmark(name, setup, run):
+        return run_benchmark(name, setup, run, repeats, min_sample_seconds, reference_setup)
+
+    results = {
+        "parse_decomposition": benchmark(
+            "parse_decomposition", lambda: (qdmrs, len(qdmrs)),
+            lambda inputs: [parse_decomposition(qdmr) for qdmr in inputs]),
+        "StepIdentifier.identify": benchmark(
+            "StepIdentifier.identify", lambda: ([parse_decomposition(qdmr) for qdmr in qdmrs], len(qdmrs)),
+            identify_steps),
+    }
+    for name, transform_class in transform_classes.items():
+        name = f"{name}.transformations"
+        results[name] = benchmark(name, lambda: (examples(), len(records)), apply_transform(transform_class))
+
+    def filter_setup():
+        transformed = transformed_examples()
+        return transformed, len(transformed)
+
+    results["TransformFilter.filter_out"] = benchmark(
+        "TransformFilter.filter_out", filter_setup,
+        lambda inputs: [transform_filter.filter_out(example) for example in inputs])
+    results["QDMREditor"] = benchmark(
+        "QDMREditor", lambda: (qdmrs, len(qdmrs)),
+        lambda inputs: [qdmr_edits(qdmr) for qdmr in inputs])
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold, memory_floor_kb=DEFAULT_MEMORY_FLOOR_KB):
+    """Return the list of benchmarks that regressed beyond the threshold"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            print(f"* {name}: no baseline")
+            continue
+        base = baseline[name]
+        # the speed relative to the reference pass, which does not depend on the speed of the machine
+        if result["relative_speed"] < base["relative_speed"] * (1 - threshold):
+            regressions.append(f"{name}: {result['relative_speed']} relative speed, {result['qdmrs_per_sec']} "
+                               f"QDMRs/sec (baseline: {base['relative_speed']}, {base['qdmrs_per_sec']})")
+        if result["peak_memory_kb"] > base["peak_memory_kb"] * (1 + threshold) and \
+                result["peak_memory_kb"] - base["peak_memory_kb"] >= memory_floor_kb:
+            regressions.append(f"{name}: {result['peak_memory_kb']} KB peak memory "
+                               f"(baseline: {base['peak_memory_kb']})")
+    return regressions
+
+
+def main():
+    """Benchmarks the QDMR transformation pipeline over synthetic and sampled QDMRs with 1-20 steps,
+    and compares the results (QDMRs/sec and peak memory) against a stored baseline."""
+    args = get_args()
+    if not args.real_spacy:
+        install_spacy_stub()
+    rng = random.Random(args.seed)
+    records = synthetic_qdmrs(args.num_synthetic, rng)
+    if args.qdmrs_path is not None:
+        records += sampled_qdmrs(args.qdmrs_path, args.num_sampled, rng)
+    config = {
+        "num_synthetic": args.num_synthetic,
+        "num_sampled": args.num_sampled if args.qdmrs_path is not None else 0,
+        "qdmrs_path": os.path.basename(args.qdmrs_path) if args.qdmrs_path is not None else None,
+        "seed": args.seed,
+        "real_spacy": args.real_spacy,
+        "version": BENCHMARK_VERSION
+    }
+    print(f"benchmarking {len(records)} QDMRs ({config}).")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        qdmrs_csv_path = os.path.join(tmp_dir, "qdmrs.csv")
+        write_qdmrs_csv(records, qdmrs_csv_path)
+        results = run_benchmarks(records, qdmrs_csv_path, args.repeats, args.min_sample_seconds)
+
+    if args.save_baseline:
+        with open(args.baseline_path, "w") as fd:
+            json.dump({"config": config, "results": results}, fd, indent=4)
+        print(f"saved baseline to: {args.baseline_path}")
+        return True
+
+    if not os.path.exists(args.baseline_path):
+        print(f"no baseline found in: {args.baseline_path} (run with --save_baseline to create one)")
+        return True
+    with open(args.baseline_path, "r") as fd:
+        baseline = json.load(fd)
+    if baseline["config"] != config:
+        print(f"the baseline was measured with a different configuration: {baseline['config']}")
+        return False
+    regressions = compare_to_baseline(results, baseline["results"], args.threshold, args.memory_floor_kb)
+    for regression in regressions:
+        print(f"* regression: {regression}")
+    print(f"found {len(regressions)} regressions (threshold: {args.threshold}).")
+    return len(regressions) == 0
+
+
+if __name__ == "__main__":
+    exit(0 if main() else 1)
@@ -0,0 +1,63 @@
+import argparse
+import csv
+import time
+
+from qdmr_transforms.qdmr_identifier import StepIdentifier
+from qdmr_transforms.utils import parse_decomposition
+
+
+def get_args():
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--qdmrs_path", type=str, required=True,
+                       help="path to a csv file with QDMRs in the Break format (e.g., the Break dev set)")
+    parse.add_argument("--max_mismatches_to_print", type=int, default=20)
+    return parse.parse_args()
+
+
+def identify(step_identifier, step_text):
+    """Returns the identified (operator, arguments) of a step, or the type of the raised error"""
+    try:
+        step = step_identifier.identify(step_text)
+        return step.operator, step.arguments
+    except Exception as e:
+        return type(e).__name__, None
+
+
+def read_steps(qdmrs_path):
+    steps = []
+    with open(qdmrs_path, "r", encoding="utf-8") as fd:
+        for record in csv.DictReader(fd):
+            steps += parse_decomposition(record["decomposition"])
+    return steps
+
+
+def main():
+    """Checks that the single-pass operator classifier identifies the same operators and arguments
+    as the operator identifiers, and compares their running times."""
+    args = get_args()
+    steps = read_steps(args.qdmrs_path)
+    print(f"read {len(steps)} QDMR steps.")
+
+    results = {}
+    for compiled in [False, True]:
+        step_identifier = StepIdentifier(compiled=compiled)
+        start = time.time()
+        results[compiled] = [identify(step_identifier, step_text) for step_text in steps]
+        elapsed = time.time() - start
+        name = "compiled classifier" if compiled else "operator identifiers"
+        print(f"{name}: {round(elapsed, 2)} sec. ({round(len(steps) / max(elapsed, 1e-9))} steps/sec)")
+
+    mismatches = [
+        (step_text, expected, actual)
+        for step_text, expected, actual in zip(steps, results[False], results[True])
+        if expected != actual
+    ]
+    for step_text, expected, actual in mismatches[:args.max_mismatches_to_print]:
+        print(f"* {step_text}\n\texpected: {expected}\n\tactual: {actual}")
+    print(f"found {len(mismatches)} mismatches out of {len(steps)} steps.")
+
+    return len(mismatches) == 0
+
+
+if __name__ == "__main__":
+    exit(0 if main() else 1)
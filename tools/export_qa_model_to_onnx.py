@@ -0,0 +1,55 @@
+import argparse
+import json
+
+import numpy as np
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+
+from src.models.qa.onnx_qa_model import DEFAULT_OPSET_VERSION, export_qa_model, use_onnx_qa_model
+
+
+def get_best_spans(model, instances, batch_size):
+    best_spans, best_span_scores = [], []
+    for batch_start in range(0, len(instances), batch_size):
+        for output in model.forward_on_instances(instances[batch_start: batch_start + batch_size]):
+            best_spans.append(tuple(output["best_span"].tolist()))
+            best_span_scores.append(float(output["best_span_scores"]))
+    return best_spans, np.array(best_span_scores)
+
+
+def main(args):
+    import_module_and_submodules("src")
+    overrides = json.dumps({"validation_dataset_reader": {"max_instances": args.max_instances, "pickle": None}})
+    archive = load_archive(args.qa_model_path, cuda_device=-1, overrides=overrides)
+    model = archive.model
+    model.eval()
+    export_qa_model(model, args.output_path, opset_version=args.opset_version)
+    print(f"exported the QA model of {args.qa_model_path} to {args.output_path}")
+
+    if args.verify_data_path is not None:
+        predictor = Predictor.from_archive(archive)
+        instances = list(predictor._dataset_reader.read(args.verify_data_path))
+        torch_best_spans, torch_scores = get_best_spans(model, instances, args.batch_size)
+        use_onnx_qa_model(model, args.output_path)
+        onnx_best_spans, onnx_scores = get_best_spans(model, instances, args.batch_size)
+        num_same = sum(torch_span == onnx_span for torch_span, onnx_span in zip(torch_best_spans, onnx_best_spans))
+        print(f"identical best spans: {num_same}/{len(instances)}, "
+              f"max best span score difference: {np.abs(torch_scores - onnx_scores).max(initial=0):.2e}")
+        if num_same != len(instances):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--qa_model_path", type=str, required=True, help="transformer_qa_v2 archive")
+    parse.add_argument("--output_path", type=str, required=True, help="path of the exported ONNX file")
+    parse.add_argument("--opset_version", type=int, default=DEFAULT_OPSET_VERSION)
+    parse.add_argument("--verify_data_path", type=str, default=None,
+                       help="QA fixture (in the format of the archive reader) to verify that the exported model "
+                            "predicts the same best spans as the PyTorch one on")
+    parse.add_argument("--max_instances", type=int, default=200)
+    parse.add_argument("--batch_size", type=int, default=8)
+    args = parse.parse_args()
+
+    main(args)
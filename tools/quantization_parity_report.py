@@ -0,0 +1,128 @@
+import argparse
+import io
+import json
+import time
+
+import torch
+from allennlp.common.util import import_module_and_submodules
+from allennlp.models.archival import load_archive
+from allennlp.predictors import Predictor
+
+from src.models.quantization import load_quantized_archive
+
+# the prediction of every output of the models, to count the predictions that quantization changes
+PREDICTION_KEYS = {"transformer_qa_v2": "best_span_str", "q_gen": "questions"}
+
+
+def get_model_size_mb(model):
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2 ** 20
+
+
+def evaluate(model_path, data_path, predictor_name, quantize, batch_size, max_instances):
+    """Runs the archive model on the instances of the data file (read by the validation dataset reader of
+    the archive), and returns its metrics, predictions, throughput and size."""
+    overrides = json.dumps({"validation_dataset_reader": {"max_instances": max_instances, "pickle": None}})
+    load = load_quantized_archive if quantize else load_archive
+    archive = load(model_path, cuda_device=-1, overrides=overrides)
+    predictor = Predictor.from_archive(archive, predictor_name=predictor_name)
+    model = predictor._model
+    model.eval()
+    instances = list(predictor._dataset_reader.read(data_path))
+
+    model.get_metrics(reset=True)
+    predictions = []
+    start = time.perf_counter()
+    for batch_start in range(0, len(instances), batch_size):
+        outputs = model.forward_on_instances(instances[batch_start: batch_start + batch_size])
+        predictions += [output[PREDICTION_KEYS[predictor_name]] for output in outputs]
+    seconds = time.perf_counter() - start
+    return {
+        "metrics": model.get_metrics(reset=True),
+        "predictions": predictions,
+        "instances_per_second": len(instances) / seconds,
+        "model_size_mb": get_model_size_mb(model),
+    }
+
+
+def is_numeric(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def get_report_section(title, model_path, data_path, fp32, int8):
+    num_instances = len(fp32["predictions"])
+    num_same = sum(
+        fp32_prediction == int8_prediction
+        for fp32_prediction, int8_prediction in zip(fp32["predictions"], int8["predictions"])
+    )
+    # the numeric metrics of both runs (a metric may be missing from one of them)
+    rows = [
+        (name, value, int8["metrics"][name])
+        for name, value in fp32["metrics"].items()
+        if is_numeric(value) and is_numeric(int8["metrics"].get(name)) and not name.endswith("count")
+    ]
+    rows += [
+        ("instances/sec", fp32["instances_per_second"], int8["instances_per_second"]),
+        ("model size (MB)", fp32["model_size_mb"], int8["model_size_mb"]),
+    ]
+    lines = [
+        f"## {title}",
+        f"`{model_path}` on `{data_path}` ({num_instances} instances)",
+        "",
+        "| | fp32 | int8 | int8 - fp32 |",
+        "|---|---|---|---|",
+    ]
+    lines += [f"| {name} | {fp32_value:.4f} | {int8_value:.4f} | {int8_value - fp32_value:+.4f} |"
+              for name, fp32_value, int8_value in rows]
+    lines += [
+        "",
+        f"Same predictions: {num_same}/{num_instances} ({num_same / max(num_instances, 1):.1%}), "
+        f"speedup: {int8['instances_per_second'] / fp32['instances_per_second']:.2f}x",
+        "",
+    ]
+    return lines
+
+
+def main(args):
+    import_module_and_submodules("src")
+    if args.torch_threads is not None:
+        torch.set_num_threads(args.torch_threads)
+
+    lines = [
+        "# Dynamic int8 quantization parity report",
+        f"torch {torch.__version__}, {torch.get_num_threads()} threads, batch size {args.batch_size}",
+        "",
+    ]
+    models = [
+        ("QA (EM/F1)", args.qa_model_path, args.qa_data_path, "transformer_qa_v2"),
+        ("Question generation (SARI)", args.q_gen_model_path, args.q_gen_data_path, "q_gen"),
+    ]
+    for title, model_path, data_path, predictor_name in models:
+        if model_path is None:
+            continue
+        fp32 = evaluate(model_path, data_path, predictor_name, False, args.batch_size, args.max_instances)
+        int8 = evaluate(model_path, data_path, predictor_name, True, args.batch_size, args.max_instances)
+        lines += get_report_section(title, model_path, data_path, fp32, int8)
+
+    report = "\n".join(lines)
+    print(report)
+    if args.output_file is not None:
+        with open(args.output_file, "w", encoding="utf-8") as f:
+            f.write(report)
+
+
+if __name__ == "__main__":
+    parse = argparse.ArgumentParser()
+    parse.add_argument("--qa_model_path", type=str, help="transformer_qa_v2 archive")
+    parse.add_argument("--qa_data_path", type=str, help="QA fixture with answers, in the format of the archive reader")
+    parse.add_argument("--q_gen_model_path", type=str, help="q_gen archive")
+    parse.add_argument("--q_gen_data_path", type=str,
+                       help="question generation fixture with gold questions, in the format of the archive reader")
+    parse.add_argument("--max_instances", type=int, default=200)
+    parse.add_argument("--batch_size", type=int, default=8)
+    parse.add_argument("--torch_threads", type=int, default=None)
+    parse.add_argument("--output_file", type=str, default=None, help="path to write the (markdown) report to")
+    args = parse.parse_args()
+
+    main(args)